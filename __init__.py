@@ -6,7 +6,9 @@
     :license: GPLv3, see LICENSE for more details.
 """
 from trytond.pool import Pool
-from activity_stream import NereidUser, Activity, ActivityAllowedModel
+from activity_stream import NereidUser, Activity, ActivityAllowedModel, \
+    ActivityTimeline
+from retention import ActivityRetention, ActivityArchive
 
 
 def register():
@@ -17,5 +19,8 @@ def register():
         NereidUser,
         Activity,
         ActivityAllowedModel,
+        ActivityTimeline,
+        ActivityRetention,
+        ActivityArchive,
         module='nereid_activity_stream', type_='model'
     )
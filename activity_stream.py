@@ -7,15 +7,56 @@
     :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
+import base64
+import calendar
+import copy
+import hashlib
+import heapq
+import re
+import time
+import zlib
+from datetime import datetime, timedelta
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from sql import Null, Cast, Literal
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
+from sql.functions import Extract, CurrentTimestamp, Floor, SplitPart
+
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool, PoolMeta
-from trytond.exceptions import UserError
+from trytond.transaction import Transaction
+from trytond import backend
+from trytond.config import config
+
+from flask import Response, json, stream_with_context
+from nereid import request, jsonify, login_required, route, abort
 
-from nereid import request, jsonify, login_required, route
+from stream_cache import serialized_cache, public_window, StatsCache
+from broker import activity_broker
+from recorder import activity_recorder
+from datamanager import after_commit
+from metrics import activity_metrics, instrument_response
 
-__all__ = ['NereidUser', 'Activity', 'ActivityAllowedModel']
+__all__ = [
+    'NereidUser', 'Activity', 'ActivityAllowedModel', 'ActivityTimeline'
+]
 __metaclass__ = PoolMeta
 
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Fields which could be asked for in the sparse serialization of the
+# activities. The sub-objects are fully serialized, or only identified
+# with the .id suffix which does not read them.
+SPARSE_FIELDS = frozenset([
+    'id', 'published', 'verb', 'actor', 'object', 'target',
+    'actor.id', 'object.id', 'target.id',
+])
+
 
 class NereidUser:
     "Nereid User"
@@ -59,17 +100,485 @@ class Activity(ModelSQL, ModelView):
     target = fields.Reference(
         "Target", selection='models_get', select=True,
     )
-    score = fields.Function(
-        fields.Integer('Score'), 'get_score'
+    object_model = fields.Char('Object Model', readonly=True)
+    object_id = fields.Integer('Object ID', readonly=True)
+    target_model = fields.Char('Target Model', readonly=True)
+    target_id = fields.Integer('Target ID', readonly=True)
+    dedup_key = fields.Char('Deduplication Key', readonly=True)
+    score = fields.Integer('Score', readonly=True, select=True)
+    timeline = fields.One2Many(
+        'nereid.activity.timeline', 'activity', 'Timeline', readonly=True
     )
     event_time = fields.Function(
         fields.Char('Event Time'), 'get_event_time'
     )
 
+    _models_cache = StatsCache(
+        'nereid_activity_stream.activity.models_get', context=False
+    )
+    _count_cache = StatsCache('nereid_activity_stream.activity.count')
+
     @classmethod
     def __setup__(cls):
         super(Activity, cls).__setup__()
-        cls._order = [('create_date', 'DESC')]
+        cls._order = [('create_date', 'DESC'), ('id', 'DESC')]
+        # Projections which could be asked for by name with the fields
+        # argument of the streams, modules could register theirs here
+        cls._projections = {
+            'ids': [
+                'id', 'published', 'verb', 'actor.id', 'object.id',
+                'target.id',
+            ],
+        }
+        cls._error_messages.update({
+            'missing_value': 'Activity at row %s has no "%s".',
+            'invalid_reference': (
+                'Activity at row %s refers to "%s" which is not an allowed '
+                'model.'
+            ),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        table = TableHandler(cursor, cls, module_name)
+        # Migration from 3.4.0.1: score was a function field
+        score_exist = table.column_exist('score')
+        # Migration from 3.4.0.1: add object_model and target_model
+        reference_models_exist = table.column_exist('object_model')
+        # Migration from 3.4.0.1: add object_id and target_id
+        reference_ids_exist = table.column_exist('object_id')
+
+        super(Activity, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        # Backs the stream order and the keyset pagination on it
+        table.index_action(['create_date', 'id'], 'add')
+        # Back the filters of the streams, which are ordered by create_date
+        table.index_action(['actor', 'create_date'], 'add')
+        table.index_action(['verb', 'create_date'], 'add')
+        table.index_action(['object_model', 'create_date'], 'add')
+        # Back the target filter and the streams of an object or a target
+        table.index_action(
+            ['object_model', 'object_id', 'create_date'], 'add'
+        )
+        table.index_action(
+            ['target_model', 'target_id', 'create_date'], 'add'
+        )
+        # Partial unique index on the deduplication key, which is only set
+        # when the deduplication is enabled
+        index_name = '%s_dedup_key_uniq' % cls._table
+        if index_name not in table._indexes:
+            cursor.execute(
+                'CREATE UNIQUE INDEX "%s" ON "%s" (dedup_key) '
+                'WHERE dedup_key IS NOT NULL' % (index_name, cls._table)
+            )
+
+        if not score_exist:
+            cls.fill_score()
+        if not reference_models_exist or not reference_ids_exist:
+            cls.fill_reference_models()
+
+    @staticmethod
+    def get_reference_model(reference):
+        '''
+        Returns the model name of the value of a Reference field
+        '''
+        if not reference:
+            return None
+        if isinstance(reference, basestring):
+            return reference.split(',', 1)[0]
+        if isinstance(reference, (list, tuple)):
+            return reference[0]
+        return reference.__name__
+
+    @staticmethod
+    def get_reference_id(reference):
+        '''
+        Returns the id of the record of the value of a Reference field
+        '''
+        if not reference:
+            return None
+        if isinstance(reference, basestring):
+            try:
+                return int(reference.split(',', 1)[1])
+            except (IndexError, ValueError):
+                return None
+        if isinstance(reference, (list, tuple)):
+            return int(reference[1])
+        return reference.id
+
+    @classmethod
+    def get_reference_values(cls, name, reference):
+        '''
+        Returns the dictionary of the values of the model and id columns
+        mirroring the value of the Reference field name
+        '''
+        return {
+            '%s_model' % name.rstrip('_'): cls.get_reference_model(reference),
+            '%s_id' % name.rstrip('_'): cls.get_reference_id(reference),
+        }
+
+    @classmethod
+    def fill_reference_models(cls):
+        '''
+        Store the model and id of the object and target of all the
+        activities.
+
+        On PostgreSQL, the references are split by the database with a
+        single update per column. Otherwise the models are stored with one
+        update per model and batch of IN_MAX references, and the ids with
+        one update per batch of IN_MAX references of the same id.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        for column, model_column, id_column in (
+                (table.object_, table.object_model, table.object_id),
+                (table.target, table.target_model, table.target_id)):
+            if backend.name() == 'postgresql':
+                cursor.execute(*table.update(
+                    [model_column, id_column], [
+                        SplitPart(column, ',', 1),
+                        Cast(SplitPart(column, ',', 2), 'INTEGER'),
+                    ],
+                    where=column != Null
+                ))
+                continue
+
+            cursor.execute(*table.select(
+                column, where=column != Null, group_by=[column]
+            ))
+            models, ids = {}, {}
+            for reference, in cursor.fetchall():
+                models.setdefault(
+                    cls.get_reference_model(reference), []
+                ).append(reference)
+                ids.setdefault(
+                    cls.get_reference_id(reference), []
+                ).append(reference)
+            for values, value_column in (
+                    (models, model_column), (ids, id_column)):
+                for value, references in values.iteritems():
+                    for i in range(0, len(references), cursor.IN_MAX):
+                        cursor.execute(*table.update(
+                            [value_column], [value],
+                            where=column.in_(
+                                references[i:i + cursor.IN_MAX]
+                            )
+                        ))
+
+    @classmethod
+    def create(cls, vlist):
+        '''
+        Create the activities. When the deduplication is enabled, the
+        activities equal to an activity recorded within the interval are
+        not created and the existing activity is returned instead, see
+        deduplicate.
+        '''
+        vlist = [v.copy() for v in vlist]
+        interval = cls.get_dedup_interval()
+        window = cls.get_dedup_window(interval) if interval else None
+        keys, previous_keys = [], []
+        for values in vlist:
+            for name in ('object_', 'target'):
+                values.update(
+                    cls.get_reference_values(name, values.get(name))
+                )
+            previous_key = None
+            # The incomplete rows are left to the validation of the fields
+            if interval and all(
+                    values.get(n) for n in ('actor', 'verb', 'object_')):
+                values['dedup_key'], previous_key = cls.get_dedup_keys(
+                    values['actor'], values['verb'], values['object_'],
+                    values.get('target'), window
+                )
+            keys.append(values.get('dedup_key'))
+            previous_keys.append(previous_key)
+
+        def insert(vlist):
+            return map(int, super(Activity, cls).create(vlist))
+
+        if interval:
+            ids, new_ids = cls.deduplicate(vlist, keys, previous_keys, insert)
+        else:
+            ids = new_ids = insert(vlist)
+        cls.fill_score(new_ids)
+        activities = cls.browse(new_ids)
+        if cls.fanout_enabled():
+            cls.fanout(activities)
+        cls.publish(activities)
+        return cls.browse(ids)
+
+    @staticmethod
+    def get_dedup_interval():
+        '''
+        Returns the number of seconds of the dedup_interval option of the
+        activity_stream section of the configuration, within which an
+        activity equal to a recorded one is not recorded again. 0, the
+        default, disables the deduplication.
+        '''
+        return config.getint('activity_stream', 'dedup_interval', default=0)
+
+    @staticmethod
+    def get_dedup_window(interval):
+        '''
+        Returns the index of the current window of interval seconds
+        '''
+        return int(time.time()) // interval
+
+    @classmethod
+    def get_dedup_keys(cls, actor, verb, object_, target, window):
+        '''
+        Returns the deduplication key of the activity in the window of the
+        given index, which it is recorded with, and its key in the previous
+        window. The keys are hashes of the actor, verb, object and target
+        of the activity and of the index of the window.
+
+        The windows are fixed so that the keys do not depend on the other
+        activities. An activity recorded with either key is a duplicate, so
+        that the duplicates straddling two windows are found too.
+        '''
+        def reference(value):
+            if not value or isinstance(value, basestring):
+                return value or ''
+            if isinstance(value, (list, tuple)):
+                return '%s,%s' % tuple(value)
+            return '%s,%s' % (value.__name__, value.id)
+
+        values = [
+            unicode(int(actor)), verb, reference(object_), reference(target),
+        ]
+        return tuple(
+            hashlib.sha1(
+                u'\0'.join(values + [unicode(index)]).encode('utf-8')
+            ).hexdigest()[:32]
+            for index in (window, window - 1)
+        )
+
+    @classmethod
+    def get_dedup_ids(cls, keys):
+        '''
+        Returns a dictionary of the deduplication keys of the recorded
+        activities and their id, with a single lookup of the unique index
+        per IN_MAX keys.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        keys = list(set(keys))
+        result = {}
+        for i in range(0, len(keys), cursor.IN_MAX):
+            cursor.execute(*table.select(
+                table.dedup_key, table.id,
+                where=table.dedup_key.in_(keys[i:i + cursor.IN_MAX])
+            ))
+            result.update(cursor.fetchall())
+        return result
+
+    @classmethod
+    def deduplicate(cls, rows, keys, previous_keys, insert):
+        '''
+        Insert the rows which are neither duplicates of a recorded activity
+        nor of a previous row, and return the list of the ids of the
+        activities of all the rows in the same order and the list of the
+        ids of the inserted ones.
+
+        The recorded duplicates are looked up on their key and on their key
+        in the previous window with a single query on the unique index. A
+        concurrent transaction recording the same activity makes the insert
+        fail on the unique index, in which case it is rolled back to a
+        savepoint on PostgreSQL and the rows are deduplicated again.
+
+        :param keys: list of the deduplication keys of the rows
+        :param previous_keys: list of the keys of the rows in the previous
+                              window
+        :param insert: function inserting a list of rows and returning
+                       the list of their ids
+        '''
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        cursor = Transaction().cursor
+        savepoint = backend.name() == 'postgresql'
+
+        for attempt in range(2):
+            existing = cls.get_dedup_ids(keys + previous_keys)
+            for key, previous_key in zip(keys, previous_keys):
+                if key not in existing and previous_key in existing:
+                    existing[key] = existing[previous_key]
+            to_insert, inserted_keys, seen = [], [], set()
+            for row, key in zip(rows, keys):
+                if key not in existing and key not in seen:
+                    seen.add(key)
+                    inserted_keys.append(key)
+                    to_insert.append(row)
+            if savepoint:
+                cursor.execute('SAVEPOINT nereid_activity_dedup')
+            try:
+                new_ids = insert(to_insert) if to_insert else []
+            except DatabaseIntegrityError:
+                if not savepoint or attempt:
+                    raise
+                cursor.execute(
+                    'ROLLBACK TO SAVEPOINT nereid_activity_dedup'
+                )
+                continue
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT nereid_activity_dedup')
+            break
+
+        existing.update(zip(inserted_keys, new_ids))
+        return [existing[key] for key in keys], new_ids
+
+    @classmethod
+    def bulk_record(cls, rows, chunk_size=1000):
+        '''
+        Record many activities at once, for background jobs recording them
+        by tens of thousands, and return the list of the created ids.
+
+        The rows are validated against the allowed models once and inserted
+        with multi-row inserts of chunk_size rows, skipping the per record
+        overhead of create. When the deduplication is enabled, the id of
+        the existing activity is returned for the duplicated rows, see
+        deduplicate.
+
+        :param rows: list of dictionaries with the actor, verb, object_ and
+                     optionally target of the activities, the actor and
+                     references being records or ids and 'model,id'
+                     strings
+        '''
+        ModelAccess = Pool().get('ir.model.access')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+
+        ModelAccess.check(cls.__name__, 'create')
+
+        allowed_models = cls.get_allowed_models()
+        interval = cls.get_dedup_interval()
+        window = cls.get_dedup_window(interval) if interval else None
+        # The score is inserted along with the create date, truncated like
+        # score_from_date, instead of being filled by another update
+        if backend.name() == 'postgresql':
+            create_date = CurrentTimestamp()
+            score = Cast(Floor(Extract('EPOCH', create_date)), 'INTEGER')
+        else:
+            create_date = datetime.utcnow()
+            score = cls.score_from_date(create_date)
+        values, keys, previous_keys = [], [], []
+        for index, row in enumerate(rows, 1):
+            references = cls.check_row(index, row, allowed_models)
+            key = previous_key = None
+            if interval:
+                key, previous_key = cls.get_dedup_keys(
+                    row['actor'], row['verb'], references[0], references[1],
+                    window
+                )
+            keys.append(key)
+            previous_keys.append(previous_key)
+            values.append(
+                [int(row['actor']), row['verb']] + references +
+                map(cls.get_reference_model, references) +
+                map(cls.get_reference_id, references) +
+                [key, transaction.user, create_date, score]
+            )
+
+        columns = [
+            table.actor, table.verb, table.object_, table.target,
+            table.object_model, table.target_model,
+            table.object_id, table.target_id, table.dedup_key,
+            table.create_uid, table.create_date, table.score,
+        ]
+
+        def insert(values):
+            ids = []
+            for i in range(0, len(values), chunk_size):
+                chunk = values[i:i + chunk_size]
+                if cursor.has_returning():
+                    cursor.execute(*table.insert(
+                        columns, chunk, returning=[table.id]
+                    ))
+                    ids.extend(id_ for id_, in cursor.fetchall())
+                else:
+                    for value in chunk:
+                        cursor.execute(*table.insert(columns, [value]))
+                        ids.append(cursor.lastrowid)
+            return ids
+
+        if interval:
+            ids, new_ids = cls.deduplicate(
+                values, keys, previous_keys, insert
+            )
+        else:
+            ids = new_ids = insert(values)
+
+        activities = cls.browse(new_ids)
+        if cls.fanout_enabled():
+            cls.fanout(activities)
+        cls.publish(activities)
+        return ids
+
+    @classmethod
+    def check_row(cls, index, row, allowed_models):
+        '''
+        Check the row of an activity to record and return its object_ and
+        target as 'model,id' strings, the target being None if unset.
+
+        :param index: position of the row, for the error messages
+        :param allowed_models: set of the allowed model names
+        '''
+        for name in ('actor', 'verb', 'object_'):
+            if not row.get(name):
+                cls.raise_user_error('missing_value', (index, name))
+        references = []
+        for name in ('object_', 'target'):
+            reference = row.get(name)
+            if not reference:
+                references.append(None)
+                continue
+            if not isinstance(reference, basestring):
+                reference = '%s,%s' % (reference.__name__, reference.id)
+            if reference.split(',', 1)[0] not in allowed_models:
+                cls.raise_user_error('invalid_reference', (index, reference))
+            references.append(reference)
+        return references
+
+    @classmethod
+    def record_async(cls, actor, verb, object_, target=None):
+        '''
+        Record an activity in the background instead of in the transaction
+        of the caller, for the hot pages which should not wait on the
+        insert nor lock the activity table.
+
+        The activity is checked at once and queued once the transaction of
+        the caller is committed, for the activity_recorder to record it
+        along with the others in batches. It is dropped when the
+        transaction is rolled back. When the queue is full, the activity is
+        recorded synchronously in a transaction of its own.
+
+        :param actor: nereid user record or id
+        :param object_: record or 'model,id' string
+        :param target: record or 'model,id' string
+        '''
+        transaction = Transaction()
+
+        object_, target = cls.check_row(1, {
+            'actor': actor,
+            'verb': verb,
+            'object_': object_,
+            'target': target,
+        }, cls.get_allowed_models())
+        job = (
+            transaction.cursor.database_name, transaction.user,
+            transaction.context.copy(), [{
+                'actor': int(actor),
+                'verb': verb,
+                'object_': object_,
+                'target': target,
+            }],
+        )
+        after_commit(activity_recorder.put, *job)
 
     @classmethod
     def get_event_time(cls, records, name):
@@ -81,165 +590,1942 @@ class Activity(ModelSQL, ModelView):
             res[record.id] = str(record.create_date)
         return res
 
-    def get_score(self, name):
+    @staticmethod
+    def score_from_date(create_date):
         """
         Returns an integer score which could be used for sorting the activities
         by external system like caches, which may not be able to sort on the
         date
 
-        This score is based on the create date of the activity.
+        This score is the number of seconds since the epoch of the (UTC)
+        create date of the activity.
 
-        :param name: name of field.
+        :param create_date: create date of the activity.
 
         :return: Integer Score.
         """
-        return int(self.create_date.strftime('%s'))
+        return calendar.timegm(create_date.timetuple())
+
+    @classmethod
+    def fill_score(cls, activities=None):
+        """
+        Store the score of the given activities, or of all the activities
+        without a score when none are given.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        if activities is None:
+            where = (table.score == Null)
+        else:
+            ids = map(int, activities)
+            if not ids:
+                return
+            where = table.id.in_(ids)
+
+        if backend.name() == 'postgresql':
+            # Truncate like score_from_date, the cast alone would round
+            epoch = Floor(Extract('EPOCH', table.create_date))
+            cursor.execute(*table.update(
+                [table.score], [Cast(epoch, 'INTEGER')],
+                where=where
+            ))
+        else:
+            cursor.execute(*table.select(
+                table.id, table.create_date, where=where
+            ))
+            for id_, create_date in cursor.fetchall():
+                cursor.execute(*table.update(
+                    [table.score], [cls.score_from_date(create_date)],
+                    where=(table.id == id_)
+                ))
+
+        if activities is not None:
+            # The update bypasses the ORM, so clean the cursor cache the same
+            # way ModelSQL.write does
+            for cache in cursor.cache.values():
+                if cls.__name__ in cache:
+                    for id_ in ids:
+                        if id_ in cache[cls.__name__]:
+                            cache[cls.__name__][id_].clear()
 
     @classmethod
     def models_get(cls):
         '''
         Return valid models where activity stream could have valid objects
         and targets.
+
+        The selection is cached per database until an allowed model is
+        created, written or deleted.
         '''
         ActivityAllowedModel = Pool().get('nereid.activity.allowed_model')
 
-        activity_allowed_models = ActivityAllowedModel.search([])
-        res = [(None, '')]
-        for allowed_model in activity_allowed_models:
-            res.append((allowed_model.model.model, allowed_model.name))
-        return res
+        res = cls._models_cache.get(None)
+        if res is None:
+            activity_allowed_models = ActivityAllowedModel.search([])
+            res = [(None, '')]
+            for allowed_model in activity_allowed_models:
+                res.append((allowed_model.model.model, allowed_model.name))
+            res = tuple(res)
+            cls._models_cache.set(None, res)
+        return list(res)
+
+    @classmethod
+    def get_allowed_models(cls):
+        '''
+        Return the set of the names of the models allowed as object or
+        target, to check the activities against in constant time.
+        '''
+        return frozenset(model for model, _ in cls.models_get() if model)
 
     def serialize(self):
         '''
         Return a JSON Seralizable dictionary that could be stored in a
         cache and sent by XHR.
 
-        If additional information needs to be passed with the serialized data,
-        a subclass could get the returned dictionary and inject properties
-        anywhere in the dictionary (to be JSON object). This is respected by
-        the JSON Activity Streams 1.0 spec.
+        The streams serialize the activities in bulk with serialize_many,
+        which does not call this method. Subclasses injecting additional
+        properties in the serialized data should extend _serialize instead,
+        which both use.
         '''
-        if not self.search([('id', '=', self.id)], count=True):
-            return None
+        items = self.serialize_many([self])
+        return items[0] if items else None
 
-        if not self.object_:
-            # When the object_ which caused the activity is no more
-            # the value will be False
-            return None
+    @classmethod
+    def serialize_many(cls, activities, field_names=None):
+        '''
+        Serialize the given activities in bulk and return the list of
+        dictionaries in the same order, leaving out activities which no
+        longer exist or whose object_ or target no longer exist.
+
+        When field_names is given, only these fields are serialized, see
+        _serialize_sparse.
 
+        Instead of checking and reading every activity on its own, the
+        existence of the activities is checked with a single search, and the
+        objects and targets are grouped by model so that each model is
+        searched and browsed only once.
+
+        The serialized activities are cached along with the create and last
+        write dates of the activity, actor, object and target, and are served
+        from the cache as long as none of them changed.
+
+        :param activities: list of activity records
+        :param field_names: list of the names of SPARSE_FIELDS to serialize
+        '''
+        with activity_metrics.timer('serialize'):
+            if field_names is None:
+                serialized = cls._serialize_many(activities)
+            else:
+                serialized = cls._serialize_sparse(activities, field_names)
+        activity_metrics.increment(
+            'dangling', len(set(a.id for a in activities) - set(serialized))
+        )
+        return [serialized[a.id] for a in activities if a.id in serialized]
+
+    @classmethod
+    def _serialize_many(cls, activities):
+        '''
+        Return a dictionary of the ids and serialized dictionaries of the
+        activities which could be serialized.
+        '''
+        transaction = Transaction()
+
+        versions = cls._get_versions(cls, [a.id for a in activities])
+        activities = cls.browse([a.id for a in activities if a.id in versions])
+
+        references = []
+        for activity in activities:
+            references.append(('nereid.user', activity.actor.id))
+            for record in (activity.object_, activity.target):
+                if record:
+                    references.append((record.__name__, record.id))
+        records = cls._get_records(references)
+
+        # Version and records of the activities which could be serialized
+        serializable = {}
+        for activity in activities:
+            if not activity.object_:
+                # When the object_ which caused the activity is no more
+                # the value will be False
+                continue
+            references = [
+                ('nereid.user', activity.actor.id),
+                (activity.object_.__name__, activity.object_.id),
+                (activity.target.__name__, activity.target.id)
+                if activity.target else None,
+            ]
+            if not all(r in records for r in references if r is not None):
+                # The record does not exist anymore
+                continue
+            version = (transaction.language, versions[activity.id]) + tuple(
+                records[r][1] if r is not None else None for r in references
+            )
+            serializable[activity.id] = (version, [
+                records[r][0] if r is not None else None for r in references
+            ])
+
+        database_name = transaction.cursor.database_name
+        cached = serialized_cache.get_many(database_name, dict(
+            (id_, version) for id_, (version, _) in serializable.iteritems()
+        ))
+        to_cache = {}
+        items = {}
+        for activity in activities:
+            if activity.id in cached:
+                items[activity.id] = cached[activity.id]
+            elif activity.id in serializable:
+                version, (actor, object_, target) = serializable[activity.id]
+                item = activity._serialize(actor, object_, target)
+                to_cache[activity.id] = (version, item)
+                items[activity.id] = item
+        serialized_cache.set_many(database_name, to_cache)
+        return items
+
+    @classmethod
+    def _serialize_sparse(cls, activities, field_names):
+        '''
+        Return a dictionary of the ids and serialized dictionaries of the
+        activities, with only the given fields.
+
+        The activities are read with a single query and only the actors,
+        objects and targets which are fully serialized are read, so that
+        the projections of identifiers cost one query per page. The sparse
+        activities are not cached.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        ids = [a.id for a in activities]
+        rows = []
+        for i in range(0, len(ids), cursor.IN_MAX):
+            cursor.execute(*table.select(
+                table.id, table.create_date, table.verb, table.actor,
+                table.object_, table.target,
+                where=table.id.in_(ids[i:i + cursor.IN_MAX])
+            ))
+            rows.extend(cursor.fetchall())
+
+        def reference(value):
+            if not value:
+                return None
+            model, id_ = value.split(',', 1)
+            return (model, int(id_))
+
+        activity_references = {}
+        for id_, _, _, actor, object_, target in rows:
+            activity_references[id_] = {
+                'actor': ('nereid.user', actor),
+                'object': reference(object_),
+                'target': reference(target),
+            }
+        names = [n for n in ('actor', 'object', 'target') if n in field_names]
+        records = cls._get_records([
+            refs[name] for refs in activity_references.itervalues()
+            for name in names if refs[name]
+        ])
+
+        items = {}
+        for id_, create_date, verb, _, _, _ in rows:
+            references = activity_references[id_]
+            if not references['object'] or not all(
+                    references[n] in records for n in names
+                    if references[n]):
+                continue
+            item = {}
+            for field in field_names:
+                name = field.split('.')[0]
+                if field == 'id':
+                    item['id'] = id_
+                elif field == 'published':
+                    item['published'] = create_date.isoformat()
+                elif field == 'verb':
+                    item['verb'] = verb
+                elif not references[name]:
+                    continue
+                elif field == name:
+                    record, _ = records[references[name]]
+                    item[name] = cls._serialize_record(record)
+                elif name not in field_names:
+                    model, record_id = references[name]
+                    item[name] = {
+                        'objectType': model,
+                        'id': record_id,
+                    }
+            items[id_] = item
+        return items
+
+    @classmethod
+    def _get_records(cls, references):
+        '''
+        Return a dictionary of the (model, id) references which exist and
+        their record and version, reading each model once.
+        '''
+        ids_by_model = {}
+        for model, id_ in references:
+            ids_by_model.setdefault(model, set()).add(id_)
+
+        records = {}
+        for model, ids in ids_by_model.iteritems():
+            Model = Pool().get(model)
+            model_versions = cls._get_versions(Model, ids)
+            for record in Model.browse(model_versions.keys()):
+                records[(model, record.id)] = (
+                    record, model_versions[record.id]
+                )
+        return records
+
+    def _serialize(self, actor, object_, target):
+        '''
+        Build the serialized dictionary of the activity from the already
+        fetched actor, object and target records.
+
+        This is the hook for the modules passing additional information
+        with the serialized data: a subclass could get the returned
+        dictionary and inject properties anywhere in it (to be JSON
+        object), which is respected by the JSON Activity Streams 1.0 spec.
+        The result is cached until the activity, actor, object or target
+        change, so it should only depend on them.
+        '''
         response_json = {
             "published": self.create_date.isoformat(),
-            "actor": self.actor.serialize('activity_stream'),
+            "actor": self._serialize_record(actor),
             "verb": self.verb,
+            "object": self._serialize_record(object_),
         }
+        if target is not None:
+            response_json["target"] = self._serialize_record(target)
+        return response_json
 
-        try:
-            self.object_.rec_name
-        except UserError:
-            # The record may not exist anymore which results in
-            # a read error
-            return None
-        else:
-            response_json["object"] = self.object_.serialize('activity_stream')
+    @staticmethod
+    def _serialize_record(record):
+        '''
+        Serialize the actor, object or target record, timed by model.
+        '''
+        with activity_metrics.timer('serialize.%s' % record.__name__):
+            return record.serialize('activity_stream')
 
-        if self.target:
-            try:
-                self.target.rec_name
-            except UserError:
-                # The record may not exist anymore which results in
-                # a read error
-                return None
-            else:
-                response_json["target"] = self.target.serialize(
-                    'activity_stream'
+    @staticmethod
+    def _get_versions(Model, ids):
+        '''
+        Return a dictionary of the ids which exist for the given model and
+        their version (create and last write date) using a single search.
+        '''
+        if not ids:
+            return {}
+        with Transaction().set_context(active_test=False), \
+                activity_metrics.timer('exists'):
+            return dict(
+                (row['id'], (row['create_date'], row['write_date']))
+                for row in Model.search_read(
+                    [('id', 'in', list(ids))],
+                    fields_names=['write_date', 'create_date']
                 )
+            )
 
-        return response_json
+    @classmethod
+    def copy(cls, activities, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        # The copies are fanned out again and have their own key, if they
+        # are not duplicates
+        default.setdefault('dedup_key', None)
+        default.setdefault('timeline', None)
+        return super(Activity, cls).copy(activities, default=default)
 
     @classmethod
-    def get_activity_stream_domain(cls):
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        ids = []
+        for activities, values in zip(actions, actions):
+            values = values.copy()
+            for name in ('object_', 'target'):
+                if name in values:
+                    values.update(
+                        cls.get_reference_values(name, values[name])
+                    )
+            args.extend((activities, values))
+            ids.extend(map(int, activities))
+        super(Activity, cls).write(*args)
+        serialized_cache.invalidate(Transaction().cursor.database_name, ids)
+        public_window.clear(Transaction().cursor.database_name)
+        cls._count_cache.clear()
+
+    @classmethod
+    def delete(cls, activities):
+        ids = map(int, activities)
+        super(Activity, cls).delete(activities)
+        serialized_cache.invalidate(Transaction().cursor.database_name, ids)
+        public_window.clear(Transaction().cursor.database_name)
+        cls._count_cache.clear()
+
+    @classmethod
+    def purge(cls, ids):
         '''
-        Returns the domain to get activity stream
+        Delete the activities with a single query, bypassing the ORM, for
+        maintenance jobs removing many activities at once.
         '''
-        return [
-            ('actor', '=', request.nereid_user.id)
-        ]
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.delete(where=table.id.in_(sub_ids)))
+        serialized_cache.invalidate(cursor.database_name, ids)
+        public_window.clear(cursor.database_name)
+        cls._count_cache.clear()
 
     @classmethod
-    def get_public_stream_domain(cls):
-        """
-        Returns the domain for public stream
-        """
+    def delete_references(cls, records, trigger=None):
+        '''
+        Delete the activities whose object or target is one of the records.
+        This is called by the trigger of each allowed model when its records
+        are deleted.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        record_ids = {}
+        for record in records:
+            record_ids.setdefault(record.__name__, []).append(record.id)
+        ids = []
+        for model, model_ids in record_ids.iteritems():
+            for i in range(0, len(model_ids), cursor.IN_MAX):
+                sub_ids = model_ids[i:i + cursor.IN_MAX]
+                cursor.execute(*table.select(
+                    table.id,
+                    where=(
+                        (table.object_model == model)
+                        & table.object_id.in_(sub_ids)
+                    ) | (
+                        (table.target_model == model)
+                        & table.target_id.in_(sub_ids)
+                    )
+                ))
+                ids.extend(id_ for id_, in cursor.fetchall())
+        cls.purge(ids)
+
+    @classmethod
+    def purge_dangling(cls):
+        '''
+        Delete the activities whose object or target does not exist anymore,
+        like the ones created before the allowed model had its trigger.
+        This is called by the cron.
+
+        The references are checked model by model with one query on the
+        table of the model for each batch of distinct ids, which are read
+        from the indexed model and id columns.
+        '''
+        pool = Pool()
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        ids = []
+        for model in cls.get_allowed_models():
+            Model = pool.get(model)
+            if not issubclass(Model, ModelSQL):
+                continue
+            model_table = Model.__table__()
+            for model_column, id_column in (
+                    (table.object_model, table.object_id),
+                    (table.target_model, table.target_id)):
+                cursor.execute(*table.select(
+                    id_column,
+                    where=(model_column == model) & (id_column != Null),
+                    group_by=[id_column]
+                ))
+                record_ids = [id_ for id_, in cursor.fetchall()]
+                for i in range(0, len(record_ids), cursor.IN_MAX):
+                    sub_ids = record_ids[i:i + cursor.IN_MAX]
+                    cursor.execute(*model_table.select(
+                        model_table.id, where=model_table.id.in_(sub_ids)
+                    ))
+                    existing = set(id_ for id_, in cursor.fetchall())
+                    dangling = [
+                        id_ for id_ in sub_ids if id_ not in existing
+                    ]
+                    if not dangling:
+                        continue
+                    cursor.execute(*table.select(
+                        table.id,
+                        where=(model_column == model)
+                        & id_column.in_(dangling)
+                    ))
+                    ids.extend(id_ for id_, in cursor.fetchall())
+        cls.purge(ids)
+
+    @classmethod
+    def get_activity_stream_domain(cls):
+        '''
+        Returns the domain to get activity stream
+        '''
+        if cls.fanout_enabled():
+            return cls.get_timeline_domain(request.nereid_user.id)
         return [
-            ('id', '=', None)
+            ('actor', 'in', cls.get_followed_actors(request.nereid_user.id))
         ]
 
-    @classmethod
-    @route('/activity-stream')
-    def public_stream(cls):
+    @staticmethod
+    def fanout_enabled():
         '''
-        Returns activity stream for public user
+        Returns True if the activities are fanned out on write to the
+        timelines of the subscribers of their actor.
         '''
-        offset = request.args.get('offset', 0, int)
-        limit = request.args.get('limit', 100, int)
+        return config.getboolean('activity_stream', 'fanout', default=False)
 
-        activities = cls.search(
-            cls.get_public_stream_domain(), limit=limit, offset=offset,
+    @staticmethod
+    def get_fanout_max_subscribers():
+        '''
+        Returns the number of subscribers above which the activities of an
+        actor are not fanned out on write but read from the actor on read.
+        '''
+        return config.getint(
+            'activity_stream', 'fanout_max_subscribers', default=1000
         )
 
-        items = filter(
-            None, map(lambda activity: activity.serialize(), activities)
-        )
-        return jsonify({
-            'totalItems': len(items),
-            'items': items,
-        })
+    @classmethod
+    def get_subscribers(cls, actor_ids):
+        '''
+        Returns a dictionary mapping each actor id to the set of ids of the
+        nereid users subscribed to the activities of the actor.
+
+        By default the actors are only subscribed to their own activities.
+        Modules implementing followers should extend this method.
+
+        :param actor_ids: list of ids of nereid users
+        '''
+        return dict((actor_id, set([actor_id])) for actor_id in actor_ids)
 
     @classmethod
-    @route('/user/activity-stream')
-    @login_required
-    def stream(cls):
+    def get_followed_actors(cls, user_id):
         '''
-        Return JSON Serialized Activity Stream to XHR.
-        As defined by the activity stream json specification 1.0
-        http://activitystrea.ms/specs/json/1.0/
+        Returns the ids of the actors the user is subscribed to. This is the
+        reverse of get_subscribers and should be extended along with it.
+
+        :param user_id: id of the nereid user
         '''
-        offset = request.args.get('offset', 0, int)
-        limit = request.args.get('limit', 100, int)
+        return [user_id]
 
-        activities = cls.search(
-            cls.get_activity_stream_domain(),
-            limit=limit, offset=offset,
-        )
+    @classmethod
+    def fanout(cls, activities):
+        '''
+        Add the activities to the timelines of the subscribers of their
+        actor. Actors with more subscribers than the configured maximum are
+        skipped and read by get_timeline_domain instead.
+        '''
+        Timeline = Pool().get('nereid.activity.timeline')
 
-        items = filter(
-            None, map(lambda activity: activity.serialize(), activities)
+        max_subscribers = cls.get_fanout_max_subscribers()
+        subscribers = cls.get_subscribers(
+            list(set(activity.actor.id for activity in activities))
         )
+        entries = []
+        for activity in activities:
+            user_ids = subscribers.get(activity.actor.id, set())
+            if len(user_ids) > max_subscribers:
+                continue
+            entries.extend(
+                (user_id, activity.id, activity.score) for user_id in user_ids
+            )
+        Timeline.insert_entries(entries)
 
-        return jsonify({
-            'totalItems': len(items),
-            'items': items,
-        })
-
+    @classmethod
+    def get_timeline_domain(cls, user_id):
+        '''
+        Returns the domain of the activities fanned out to the timeline of
+        the user, along with the activities of the followed actors which
+        have too many subscribers to be fanned out.
+        '''
+        read_actor_ids = cls.get_timeline_read_actors(user_id)
 
-class ActivityAllowedModel(ModelSQL, ModelView):
-    '''
-    Nereid activity allowed model
+        domain = [('timeline.user', '=', user_id)]
+        if read_actor_ids:
+            domain = [
+                'OR',
+                domain,
+                [('actor', 'in', read_actor_ids)],
+            ]
+        return domain
 
-    The model stores name (name) and model (ir.model) as list of allowed model
-    in activty.
-    '''
-    __name__ = 'nereid.activity.allowed_model'
+    @classmethod
+    def get_timeline_read_actors(cls, user_id):
+        '''
+        Returns the ids of the actors followed by the user whose activities
+        are not fanned out to the timelines as they have too many
+        subscribers.
+        '''
+        max_subscribers = cls.get_fanout_max_subscribers()
+        actor_ids = cls.get_followed_actors(user_id)
+        subscribers = cls.get_subscribers(actor_ids)
+        return [
+            actor_id for actor_id in actor_ids
+            if len(subscribers.get(actor_id, ())) > max_subscribers
+        ]
 
-    name = fields.Char("Name", required=True, select=True)
-    model = fields.Many2One('ir.model', 'Model', required=True, select=True)
+    @classmethod
+    def get_timeline_user(cls):
+        '''
+        Returns the id of the user whose timeline the stream of the user is
+        paged from by search_stream, or None if it is not fanned out.
+        Modules returning another domain from get_activity_stream_domain
+        should extend this method too.
+        '''
+        if cls.fanout_enabled():
+            return request.nereid_user.id
+        return None
 
     @classmethod
-    def __setup__(cls):
-        super(ActivityAllowedModel, cls).__setup__()
+    def get_merge_actors(cls):
+        '''
+        Returns the ids of the actors whose activities are merged into the
+        stream of the user by search_stream, or None if the stream is read
+        with a single query.
+
+        The activities are merged when the merge option of the
+        activity_stream section of the configuration is set, they are not
+        fanned out and the user follows no more actors than the
+        merge_max_actors option. The merge restricts the domain to the
+        followed actors, so it is disabled by default for the modules
+        returning another domain from get_activity_stream_domain, which
+        should extend this method too before setting the option.
+        '''
+        if (not config.getboolean('activity_stream', 'merge', default=False)
+                or cls.fanout_enabled()):
+            return None
+        actor_ids = cls.get_followed_actors(request.nereid_user.id)
+        if len(actor_ids) > config.getint(
+                'activity_stream', 'merge_max_actors', default=100):
+            return None
+        return actor_ids
+
+    @classmethod
+    def search_stream(
+            cls, domain, offset=0, limit=None, actor_ids=None,
+            timeline_user=None, max_score=None):
+        '''
+        Returns the page of the activities matching the domain in the stream
+        order. The page is read with timeline_search when the id of the user
+        whose timeline the domain is restricted to is given, or with
+        merge_search when the ids of the actors the domain is restricted to
+        are given.
+
+        :param max_score: upper bound of the score of the activities of the
+                          page, for the timeline to be read from it
+        '''
+        with activity_metrics.timer('search'):
+            if timeline_user is not None and limit:
+                return cls.timeline_search(
+                    domain, timeline_user, offset, limit, max_score
+                )
+            if actor_ids is not None and limit:
+                return cls.merge_search(domain, actor_ids, offset, limit)
+            return cls.search(domain, offset=offset, limit=limit)
+
+    @classmethod
+    def timeline_search(cls, domain, user_id, offset, limit, max_score=None):
+        '''
+        Returns the page of the activities of the timeline of the user
+        matching the domain in the stream order.
+
+        The entries of the timeline are read newest first with a range scan
+        of the (user, score, activity) index, offset + limit at a time, and
+        only the activities of each batch are checked against the domain,
+        so that a page costs two queries when the filters keep most of the
+        timeline. The activities of the followed actors which are not
+        fanned out are searched on their own and merged into the page.
+
+        :param max_score: upper bound of the score of the activities
+        '''
+        Timeline = Pool().get('nereid.activity.timeline')
+        cursor = Transaction().cursor
+        timeline = Timeline.__table__()
+        size = offset + limit
+
+        where = timeline.user == user_id
+        if max_score is not None:
+            where &= timeline.score <= max_score
+        ids, position = [], 0
+        while len(ids) < size:
+            cursor.execute(*timeline.select(
+                timeline.activity, where=where,
+                order_by=[timeline.score.desc, timeline.activity.desc],
+                offset=position, limit=size
+            ))
+            batch = [id_ for id_, in cursor.fetchall()]
+            if not batch:
+                break
+            matched = set(map(int, cls.search(
+                [domain, ('id', 'in', batch)], order=[]
+            )))
+            ids.extend(id_ for id_ in batch if id_ in matched)
+            if len(batch) < size:
+                break
+            position += size
+        activities = cls.browse(ids[:size])
+
+        read_actor_ids = cls.get_timeline_read_actors(user_id)
+        if read_actor_ids:
+            activities = dict((a.id, a) for a in activities + cls.search(
+                [domain, ('actor', 'in', read_actor_ids)], limit=size
+            )).values()
+        # The score is truncated to the second, the page is sorted in the
+        # stream order which breaks the ties on the create date
+        activities = sorted(activities, key=cls.merge_key)
+        return cls.browse([a.id for a in activities[offset:size]])
+
+    @classmethod
+    def merge_search(cls, domain, actor_ids, offset, limit):
+        '''
+        Returns the page of the activities of the actors matching the domain
+        in the stream order, without sorting all of them.
+
+        The newest offset + limit activities of each actor are read through
+        the (actor, create_date) index, and these sorted lists are merged
+        with a heap until the page is filled. The cost is bounded by the
+        size of the page times the number of actors, whatever the length
+        of their history.
+        '''
+        size = offset + limit
+        heap = []
+        for actor_id in actor_ids:
+            activities = iter(cls.search(
+                [domain, ('actor', '=', actor_id)], limit=size
+            ))
+            activity = next(activities, None)
+            if activity is not None:
+                heap.append((cls.merge_key(activity), activity, activities))
+        heapq.heapify(heap)
+
+        result = []
+        while heap and len(result) < size:
+            _, activity, activities = heap[0]
+            result.append(activity.id)
+            activity = next(activities, None)
+            if activity is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(
+                    heap, (cls.merge_key(activity), activity, activities)
+                )
+        # Browse the page at once so that its records are read together
+        return cls.browse(result[offset:])
+
+    @staticmethod
+    def merge_key(activity):
+        '''
+        Returns the key of the activity in the heap of merge_search, which
+        is the smallest for the first activity in the stream order.
+        '''
+        delta = activity.create_date - datetime(1970, 1, 1)
+        return (
+            -(delta.days * 86400 + delta.seconds) * 10 ** 6
+            - delta.microseconds,
+            -activity.id,
+        )
+
+    @classmethod
+    def get_public_stream_domain(cls):
+        """
+        Returns the domain for public stream
+        """
+        return [
+            ('id', '=', None)
+        ]
+
+    @classmethod
+    def encode_cursor(cls, activity):
+        '''
+        Return an opaque cursor for the position of the given activity in the
+        stream, which the client could pass back as `before` to get the
+        activities after it.
+        '''
+        return cls.encode_position(activity.create_date, activity.id)
+
+    @staticmethod
+    def encode_position(create_date, id_):
+        '''
+        Return the opaque cursor of the position (create_date, id) in the
+        stream order, see encode_cursor.
+        '''
+        return base64.urlsafe_b64encode('%s,%d' % (
+            create_date.strftime(CURSOR_DATE_FORMAT), id_
+        ))
+
+    @staticmethod
+    def decode_cursor(cursor):
+        '''
+        Return the (create_date, id) tuple encoded in the cursor. Aborts with
+        a 400 Bad Request if the cursor is invalid.
+        '''
+        try:
+            create_date, id_ = base64.urlsafe_b64decode(
+                str(cursor)
+            ).split(',')
+            return (
+                datetime.strptime(create_date, CURSOR_DATE_FORMAT),
+                int(id_),
+            )
+        except (TypeError, ValueError):
+            abort(400)
+
+    @classmethod
+    def get_before_domain(cls, cursor):
+        '''
+        Returns the domain for the activities older than the position of the
+        cursor in the stream order (create_date DESC, id DESC).
+
+        The leading create_date condition bounds the scan on the
+        (create_date, id) index while the rest breaks ties on the id.
+        '''
+        create_date, id_ = cls.decode_cursor(cursor)
+        return [
+            ('create_date', '<=', create_date),
+            [
+                'OR',
+                ('create_date', '<', create_date),
+                ('id', '<', id_),
+            ],
+        ]
+
+    @classmethod
+    def aggregate(
+            cls, domain, window, offset=0, limit=None, sample_size=3,
+            before=None):
+        '''
+        Group the activities matching the domain by verb, object, target and
+        window of time, newest group first, and return for each group a
+        tuple of the id of its newest activity, the number of activities,
+        the ids of up to sample_size of the most recent actors and the
+        position (create_date, id) of the group in the order of the groups.
+
+        The grouping is done by the database on the stored score, which
+        windows are computed from, so that a page of groups costs a few
+        queries whatever the number of activities collapsed in it. The
+        windows are read newest first by ranges of a growing number of
+        windows, starting from the newest activity left which is found on
+        the score index, until the page is filled. A group never spans two
+        ranges, and the groups of a range are all older than the ones of
+        the ranges before it.
+
+        :param window: length of the windows of time in seconds
+        :param before: position of a group, for the groups after it
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        activities = cls.search(domain, order=[], query=True)
+        window_ = table.score / window
+        keys = [table.verb, table.object_, table.target, window_]
+        last_date, last_id = Max(table.create_date), Max(table.id)
+
+        having = None
+        # Exclusive upper bound of the windows left to read
+        end = None
+        if before:
+            create_date, id_ = before
+            having = (last_date < create_date) | (
+                (last_date == create_date) & (last_id < id_)
+            )
+            # The window of the cursor is read whole, for its groups newer
+            # than the cursor to be dropped by the having clause instead of
+            # being cut down to their activities older than the cursor
+            end = cls.score_from_date(create_date) // window + 1
+
+        groups = []
+        span = 1
+        while limit is None or len(groups) < offset + limit:
+            where = table.id.in_(activities)
+            if end is not None:
+                where &= table.score < end * window
+            cursor.execute(*table.select(Max(table.score), where=where))
+            newest, = cursor.fetchone()
+            if newest is None:
+                break
+            end = newest // window + 1
+            start = end - span
+            cursor.execute(*table.select(
+                *(keys + [last_id, Count(Literal('*')), last_date]),
+                where=where & (table.score >= start * window)
+                & (table.score < end * window),
+                group_by=keys, having=having,
+                order_by=[last_date.desc, last_id.desc],
+                limit=None if limit is None
+                else offset + limit - len(groups)
+            ))
+            groups.extend(
+                (tuple(row[:4]), row[4], row[5], (row[6], row[4]))
+                for row in cursor.fetchall()
+            )
+            end, span = start, span * 2
+        groups = groups[offset:offset + limit] if limit is not None \
+            else groups[offset:]
+        if not groups:
+            return []
+
+        # Most recent actors of the groups of the page
+        verbs = list(set(key[0] for key, _, _, _ in groups))
+        objects = list(set(key[1] for key, _, _, _ in groups))
+        # The activities without target are matched on an empty target
+        targets = list(set(key[2] or '' for key, _, _, _ in groups))
+        windows = [key[3] for key, _, _, _ in groups]
+        cursor.execute(*table.select(
+            *(keys + [table.actor]),
+            where=(
+                table.id.in_(activities)
+                & table.verb.in_(verbs)
+                & table.object_.in_(objects)
+                & Coalesce(table.target, '').in_(targets)
+                & (table.score >= min(windows) * window)
+                & (table.score < (max(windows) + 1) * window)
+            ),
+            group_by=keys + [table.actor],
+            order_by=[Max(table.id).desc]
+        ))
+        actors = {}
+        for row in cursor.fetchall():
+            sample = actors.setdefault(tuple(row[:4]), [])
+            if len(sample) < sample_size:
+                sample.append(row[4])
+
+        return [
+            (activity_id, count, actors.get(key, []), position)
+            for key, activity_id, count, position in groups
+        ]
+
+    @classmethod
+    def serialize_aggregates(cls, aggregates):
+        '''
+        Serialize the groups returned by aggregate. Each group is the
+        serialized newest activity of the group, with the number of
+        activities of the group as `count` and the sample of actors as
+        `actors`.
+        '''
+        NereidUser = Pool().get('nereid.user')
+
+        serialized = cls._serialize_many(
+            cls.browse([aggregate[0] for aggregate in aggregates])
+        )
+        actors = dict(
+            (actor.id, actor.serialize('activity_stream'))
+            for actor in NereidUser.browse(list(set(
+                actor_id for _, _, actor_ids, _ in aggregates
+                for actor_id in actor_ids
+            )))
+        )
+
+        items = []
+        for activity_id, count, actor_ids, _ in aggregates:
+            if activity_id not in serialized:
+                continue
+            item = serialized[activity_id]
+            item['count'] = count
+            item['actors'] = [actors[actor_id] for actor_id in actor_ids]
+            items.append(item)
+        return items
+
+    @classmethod
+    def get_since_domain(cls, cursor):
+        '''
+        Returns the domain for the activities newer than the position of the
+        cursor in the stream order (create_date DESC, id DESC).
+        '''
+        create_date, id_ = cls.decode_cursor(cursor)
+        return [
+            ('create_date', '>=', create_date),
+            [
+                'OR',
+                ('create_date', '>', create_date),
+                ('id', '>', id_),
+            ],
+        ]
+
+    @staticmethod
+    def get_hot_domain():
+        '''
+        Returns the domain restricting the streams to the activities of the
+        last hot_days days when this option of the activity_stream section
+        of the configuration is set, so that the stream queries only scan
+        the recent end of the (create_date, id) index.
+
+        It only applies to the pages read from the head of the stream, see
+        stream_response: the pages with a `before` cursor or a `from` bound
+        read the older activities.
+        '''
+        hot_days = config.getint('activity_stream', 'hot_days', default=0)
+        if not hot_days:
+            return []
+        # Round to the hour to keep the domain, and thus the ETag and the
+        # cached totals, the same from one request to the next
+        now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        return [
+            ('create_date', '>=', now - timedelta(days=hot_days)),
+        ]
+
+    @classmethod
+    def get_filter_domain(cls):
+        '''
+        Returns the domain for the filters of the request arguments:
+
+            * `verb`: verbs of the activities, could be repeated
+            * `object`: models of the object, could be repeated
+            * `target`: target as 'model,id'
+            * `from` and `to`: ISO 8601 bounds of the publication time, the
+              upper bound being excluded
+
+        Each filter is backed by an index on its column and create_date.
+        '''
+        allowed_models = cls.get_allowed_models()
+        domain = []
+
+        verbs = request.args.getlist('verb')
+        if verbs:
+            domain.append(('verb', 'in', verbs))
+
+        models = request.args.getlist('object')
+        if models:
+            if not allowed_models.issuperset(models):
+                abort(400)
+            domain.append(('object_model', 'in', models))
+
+        target = request.args.get('target')
+        if target:
+            model = cls.get_reference_model(target)
+            record_id = cls.get_reference_id(target)
+            if model not in allowed_models or record_id is None:
+                abort(400)
+            domain.extend(cls.get_reference_stream_domain(
+                'target', model, record_id
+            ))
+
+        for name, operator in (('from', '>='), ('to', '<')):
+            value = request.args.get(name)
+            if value:
+                domain.append(
+                    ('create_date', operator, cls.parse_datetime(value))
+                )
+        return domain
+
+    @staticmethod
+    def get_reference_stream_domain(name, model, record_id):
+        '''
+        Returns the domain of the activities whose object or target, as
+        name, is the record of model and record_id. It is backed by the
+        index on the model and id columns and create_date, which makes the
+        stream of a record a range scan of the index.
+        '''
+        return [
+            ('%s_model' % name, '=', model),
+            ('%s_id' % name, '=', record_id),
+        ]
+
+    @classmethod
+    def get_serialize_fields(cls):
+        '''
+        Returns the fields of the activities asked for with the `fields`
+        argument, either the name of a registered projection or a comma
+        separated list of SPARSE_FIELDS, or None for the full activities.
+        Aborts with a 400 Bad Request on unknown fields.
+        '''
+        value = request.args.get('fields')
+        if not value:
+            return None
+        if value in cls._projections:
+            return cls._projections[value]
+        field_names = value.split(',')
+        if not SPARSE_FIELDS.issuperset(field_names):
+            abort(400)
+        return field_names
+
+    @staticmethod
+    def parse_datetime(value):
+        '''
+        Returns the datetime of an ISO 8601 date or UTC datetime. Aborts with
+        a 400 Bad Request if the value is invalid.
+        '''
+        value = value.rstrip('Z')
+        for format_ in (
+                CURSOR_DATE_FORMAT, '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M',
+                '%Y-%m-%d'):
+            try:
+                return datetime.strptime(value, format_)
+            except ValueError:
+                continue
+        abort(400)
+
+    @classmethod
+    @instrument_response('stream')
+    def stream_response(cls, domain, actor_ids=None, timeline_user=None):
+        '''
+        Returns the JSON response for a page of the activities matching the
+        domain.
+
+        The domain could be restricted to the activities of some actors
+        whose ids are then given as actor_ids, for the pages to be merged
+        from the activities of each actor, see merge_search, or to the
+        timeline of the user given as timeline_user, for the pages to be
+        read from the timeline, see timeline_search.
+
+        The page is selected either with the `offset` and `limit` arguments or
+        with the opaque `before` cursor returned as `next` by the previous
+        page. The cursor is preferred since every page is then an index range
+        scan however deep into the stream it is.
+
+        With the `stream` argument set, the response is streamed as the
+        activities are fetched and serialized in batches.
+
+        The response carries an ETag and a Last-Modified header built from
+        the newest activity matching the domain, and is a 304 Not Modified
+        without any serialization when the client already has it.
+
+        The activities could be filtered with the arguments described in
+        get_filter_domain, and their fields selected with the `fields`
+        argument described in get_serialize_fields.
+
+        With the `aggregate` argument set to a number of seconds, the
+        activities with the same verb, object and target within windows of
+        that length are collapsed into a single item, see aggregate. The
+        `next` cursor is then the position of the last group of the page.
+
+        Clients holding a page could poll for the activities newer than it
+        by passing the `latest` cursor of the page as `since`. When there
+        are more new activities than the limit, only the newest ones are
+        returned and `resync` is set, for the client to reload the stream.
+
+        `totalItems` is the number of the activities of the stream, or of
+        the new activities when polling, whatever the page, see
+        count_stream. `totalItemsEstimated` is set when it is an estimate.
+
+        When the hot_days option is set, the pages without a `before`
+        cursor nor a `from` bound only hold the activities of the last
+        hot_days days and `truncated` is set, see get_hot_domain. The
+        pages read with the `next` cursor or with a `from` bound are not
+        restricted, and their `totalItems` counts the older activities.
+
+        The format and compression of the pages are negotiated, see
+        make_response.
+
+        The time spent searching, counting, checking and serializing the
+        activities, rendering the response and the number of queries are
+        sent to the metrics sink, and returned in the X-Activity-Timing
+        header when the timing_header option is set, see
+        instrument_response.
+        '''
+        offset = request.args.get('offset', 0, int)
+        limit = request.args.get('limit', 100, int)
+        before = request.args.get('before')
+        since = request.args.get('since')
+
+        if since:
+            domain = [domain, cls.get_since_domain(since)]
+        # A position or a time bound given by the client reads past the
+        # hot days
+        hot_domain = cls.get_hot_domain() \
+            if not before and not request.args.get('from') else []
+        domain = [domain, cls.get_filter_domain(), hot_domain]
+        # The total is the one of the stream, not of the rest of it
+        count_domain = domain
+        max_score = None
+        if before:
+            domain = [domain, cls.get_before_domain(before)]
+            max_score = cls.score_from_date(cls.decode_cursor(before)[0])
+
+        # Answer polls with a single indexed query on the newest activity,
+        # which is not merged as it would cost a query per actor
+        top = cls.search_stream(
+            domain, limit=1, timeline_user=timeline_user, max_score=max_score
+        )
+        properties = {
+            'latest': cls.encode_cursor(top[0]) if top else None,
+        }
+        if hot_domain:
+            properties['truncated'] = True
+        etag = cls.get_stream_etag(domain, properties['latest'])
+        last_modified = top[0].create_date.replace(microsecond=0) \
+            if top else None
+
+        not_modified = cls.is_not_modified(etag, last_modified)
+        if not not_modified:
+            total, estimated = cls.count_stream(
+                count_domain,
+                cls.search_stream(count_domain, limit=1) if before else top
+            )
+            if since:
+                properties['resync'] = bool(limit) and \
+                    total > offset + limit
+
+        if not_modified:
+            response = Response(status=304)
+        elif request.args.get('aggregate', 0, int) > 0:
+            # The before cursor is the position of the last group
+            aggregates = cls.aggregate(
+                count_domain, request.args.get('aggregate', type=int),
+                offset=offset, limit=limit,
+                before=cls.decode_cursor(before) if before else None
+            )
+            next_cursor = None
+            if limit and len(aggregates) == limit:
+                next_cursor = cls.encode_position(*aggregates[-1][3])
+            properties.update({
+                'totalItems': total,
+                'totalItemsEstimated': estimated,
+                'items': cls.serialize_aggregates(aggregates),
+                'next': next_cursor,
+            })
+            response = cls.make_response(properties)
+        elif request.args.get('stream', 0, int):
+            properties.update({
+                'totalItems': total,
+                'totalItemsEstimated': estimated,
+            })
+            response = cls.streaming_response(
+                domain, offset, limit, properties, actor_ids=actor_ids,
+                timeline_user=timeline_user, max_score=max_score
+            )
+        else:
+            activities = cls.search_stream(
+                domain, offset, limit, actor_ids, timeline_user, max_score
+            )
+
+            items = cls.serialize_many(
+                activities, cls.get_serialize_fields()
+            )
+            next_cursor = None
+            if limit and len(activities) == limit:
+                next_cursor = cls.encode_cursor(activities[-1])
+
+            properties.update({
+                'totalItems': total,
+                'totalItemsEstimated': estimated,
+                'items': items,
+                'next': next_cursor,
+            })
+            response = cls.make_response(properties)
+
+        return cls.set_validators(response, etag, last_modified)
+
+    @staticmethod
+    def set_validators(response, etag, last_modified):
+        '''
+        Set the validators of the page of the stream on the response
+        '''
+        response.vary.update(['Accept', 'Accept-Encoding'])
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        return response
+
+    @classmethod
+    def public_window_response(cls):
+        '''
+        Returns the response for a page of the public stream served from
+        the public_window, or None if the page is not in the window for it
+        to be read from the database by stream_response.
+
+        The window holds the newest public_window_size activities of the
+        option of the activity_stream section of the configuration (0, the
+        default, disables it). It is loaded by the first request and the
+        new activities are added to it as they are published, so that the
+        requests for the pages within the window, with only the `offset`,
+        `limit` and `entities` arguments, do not query the database.
+        '''
+        if not public_window.size or \
+                set(request.args) - set(['offset', 'limit', 'entities']):
+            return None
+        offset = request.args.get('offset', 0, int)
+        limit = request.args.get('limit', 100, int)
+        if offset < 0 or limit <= 0:
+            return None
+
+        transaction = Transaction()
+        # The domain stream_response would build for the page
+        hot_domain = cls.get_hot_domain()
+        domain = [
+            cls.get_public_stream_domain(), cls.get_filter_domain(),
+            hot_domain,
+        ]
+        key = (
+            transaction.cursor.database_name, transaction.language,
+            repr(domain),
+        )
+        window = public_window.get(key)
+        if window is None:
+            window = cls.load_public_window(key, domain)
+        elif window['pending']:
+            window = cls.update_public_window(key, domain, window)
+
+        entries = window['entries']
+        if offset + limit > len(entries) and window['total'] > len(entries):
+            activity_metrics.increment('public_window.misses')
+            return None
+        activity_metrics.increment('public_window.hits')
+
+        page = entries[offset:offset + limit]
+        latest = entries[0][0] if entries else None
+        etag = cls.get_stream_etag(domain, latest)
+        last_modified = entries[0][1].replace(microsecond=0) \
+            if entries else None
+        if cls.is_not_modified(etag, last_modified):
+            response = Response(status=304)
+        else:
+            properties = {
+                'latest': latest,
+                'totalItems': window['total'],
+                'totalItemsEstimated': window['estimated'],
+                # The items are copied as make_response could change them
+                'items': [copy.deepcopy(item) for _, _, item in page],
+                'next': page[-1][0] if len(page) == limit else None,
+            }
+            if hot_domain:
+                properties['truncated'] = True
+            response = cls.make_response(properties)
+        return cls.set_validators(response, etag, last_modified)
+
+    @classmethod
+    def get_window_entries(cls, activities):
+        '''
+        Return the list of (cursor, create_date, item) of the activities
+        which could be serialized, for the public_window.
+        '''
+        items = cls._serialize_many(activities)
+        return [
+            (cls.encode_cursor(a), a.create_date, items[a.id])
+            for a in activities if a.id in items
+        ]
+
+    @classmethod
+    def load_public_window(cls, key, domain):
+        '''
+        Load the public_window of the key with the newest activities of
+        the domain and return it.
+        '''
+        activities = cls.search(domain, limit=public_window.size)
+        entries = cls.get_window_entries(activities)
+        total, estimated = cls.count_stream(domain, activities[:1])
+        public_window.load(key, entries, total, estimated)
+        return {
+            'entries': entries,
+            'total': total,
+            'estimated': estimated,
+            'pending': [],
+        }
+
+    @classmethod
+    def update_public_window(cls, key, domain, window):
+        '''
+        Add the pending new activities matching the domain to the
+        public_window of the key and return it. The window is loaded again
+        if they are not newer than the activities of the window.
+        '''
+        activities = cls.search([domain, ('id', 'in', window['pending'])])
+        if not activities:
+            return window
+        entries = window['entries']
+        if entries and (
+                (activities[-1].create_date, activities[-1].id)
+                <= cls.decode_cursor(entries[0][0])):
+            return cls.load_public_window(key, domain)
+
+        new_entries = cls.get_window_entries(activities)
+        public_window.prepend(key, new_entries, len(activities))
+        return {
+            'entries': (new_entries + entries)[:public_window.size],
+            'total': window['total'] + len(activities),
+            'estimated': window['estimated'],
+            'pending': [],
+        }
+
+    @classmethod
+    def get_stream_etag(cls, domain, latest):
+        '''
+        Returns the validator of a page of the activities matching the
+        domain, built from the newest of these activities and the arguments
+        of the page.
+
+        :param latest: cursor of the newest activity matching the domain if
+                       any
+        '''
+        return hashlib.sha1(repr((
+            domain,
+            sorted(request.args.items(multi=True)),
+            # Each format and encoding is another representation
+            request.headers.get('Accept'),
+            request.headers.get('Accept-Encoding'),
+            latest,
+        ))).hexdigest()
+
+    @classmethod
+    def count_stream(cls, domain, top):
+        '''
+        Returns the number of the activities matching the domain and whether
+        it is an estimate.
+
+        The activities are counted with a query stopping after the
+        count_threshold option of the activity_stream section of the
+        configuration, so that the total of most streams is exact and
+        costs an index scan bounded by the threshold. Beyond it, the total
+        is the estimate of the PostgreSQL planner, or a lower bound on the
+        other backends.
+
+        The totals are cached by domain and newest activity, which changes
+        when activities matching the domain are created, and the cache is
+        cleared when activities are deleted.
+
+        :param top: list with the newest activity matching the domain if any
+        '''
+        if not top:
+            return 0, False
+
+        key = (repr(domain), top[0].id)
+        result = cls._count_cache.get(key)
+        if result is not None:
+            return result
+
+        cursor = Transaction().cursor
+        threshold = config.getint(
+            'activity_stream', 'count_threshold', default=1000
+        )
+        with activity_metrics.timer('count'):
+            query = cls.search(
+                domain, order=[], limit=threshold + 1, query=True
+            )
+            cursor.execute(*query.select(Count(Literal('*'))))
+            count, = cursor.fetchone()
+            result = count, False
+            if count > threshold:
+                result = max(count, cls.estimate_count(domain)), True
+
+        cls._count_cache.set(key, result)
+        return result
+
+    @classmethod
+    def estimate_count(cls, domain):
+        '''
+        Returns the number of rows the PostgreSQL planner estimates the
+        search on the domain returns, from the statistics of the tables,
+        without running it. Returns 0 on the other backends.
+        '''
+        if backend.name() != 'postgresql':
+            return 0
+        cursor = Transaction().cursor
+        query, params = tuple(cls.search(domain, order=[], query=True))
+        cursor.execute('EXPLAIN ' + query, params)
+        plan, = cursor.fetchone()
+        match = re.search(r'rows=(\d+)', plan)
+        return int(match.group(1)) if match else 0
+
+    @classmethod
+    def make_response(cls, data):
+        '''
+        Returns the response for the page of the stream in the format the
+        client accepts: MessagePack when it accepts application/x-msgpack
+        and msgpack is installed, JSON otherwise. The response is then
+        compressed, see compress_response.
+
+        With the `entities` argument set, the actors, objects and targets
+        are sent once per page, see extract_entities.
+        '''
+        if request.args.get('entities', 0, int):
+            data = cls.extract_entities(data)
+
+        mimetypes = ['application/json']
+        if msgpack is not None:
+            mimetypes.append('application/x-msgpack')
+        with activity_metrics.timer('render'):
+            if request.accept_mimetypes.best_match(mimetypes) == \
+                    'application/x-msgpack':
+                response = Response(
+                    msgpack.packb(data),
+                    mimetype='application/x-msgpack'
+                )
+            else:
+                response = jsonify(data)
+            return cls.compress_response(response)
+
+    @staticmethod
+    def extract_entities(data):
+        '''
+        Move the actors, objects and targets of the items of the page to
+        the `entities` dictionary, keyed by their objectType and id as
+        'model,id', and replace them in the items by their key. An actor
+        doing many activities in the page is then sent once.
+        '''
+        entities = {}
+
+        def extract(value):
+            if not isinstance(value, dict) or \
+                    'objectType' not in value or 'id' not in value:
+                return value
+            key = '%s,%s' % (value['objectType'], value['id'])
+            entities.setdefault(key, value)
+            return key
+
+        for item in data.get('items', []):
+            for name in ('actor', 'object', 'target'):
+                if name in item:
+                    item[name] = extract(item[name])
+            if 'actors' in item:
+                item['actors'] = map(extract, item['actors'])
+        data['entities'] = entities
+        return data
+
+    @staticmethod
+    def compress_response(response):
+        '''
+        Compress the body of the response with gzip or deflate, whichever
+        the client prefers, when it is at least as large as the
+        compress_min_size option of the activity_stream section of the
+        configuration (1024 bytes by default).
+
+        The streamed responses are left to the web server.
+        '''
+        min_size = config.getint(
+            'activity_stream', 'compress_min_size', default=1024
+        )
+        if response.is_streamed or response.status_code != 200 or \
+                'Content-Encoding' in response.headers:
+            return response
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+        if encoding == 'gzip':
+            compressor = zlib.compressobj(
+                6, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+            data = compressor.compress(data) + compressor.flush()
+        elif encoding == 'deflate':
+            data = zlib.compress(data, 6)
+        else:
+            return response
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    @staticmethod
+    def is_not_modified(etag, last_modified):
+        '''
+        Returns True if the conditional headers of the request match the
+        validators of the page.
+        '''
+        if request.if_none_match:
+            return request.if_none_match.contains(etag)
+        if request.if_modified_since and last_modified:
+            return last_modified <= \
+                request.if_modified_since.replace(tzinfo=None)
+        return False
+
+    @classmethod
+    def streaming_response(
+            cls, domain, offset, limit, properties=None, batch_size=100,
+            actor_ids=None, timeline_user=None, max_score=None):
+        '''
+        Returns a response streaming the JSON of the activities matching the
+        domain, fetching and serializing them batch_size at a time, so that
+        the memory used does not depend on the limit.
+
+        The first batch is fetched at the offset and the following ones with
+        the cursor of the last activity of the previous batch.
+
+        :param properties: dictionary of additional properties of the
+                           response
+        :param actor_ids: ids of the actors the domain is restricted to, see
+                          search_stream
+        :param timeline_user: id of the user whose timeline the domain is
+                              restricted to, see search_stream
+        :param max_score: upper bound of the score of the activities
+        '''
+        transaction_manager = cls.get_transaction_manager()
+        field_names = cls.get_serialize_fields()
+
+        def generate():
+            with transaction_manager():
+                yield '{"items": ['
+                count, remaining = 0, limit
+                batch_domain, batch_offset = domain, offset
+                batch_score = max_score
+                activities = []
+                while remaining > 0:
+                    size = min(batch_size, remaining)
+                    activities = cls.search_stream(
+                        batch_domain, batch_offset, size, actor_ids,
+                        timeline_user, batch_score
+                    )
+                    for item in cls.serialize_many(activities, field_names):
+                        yield (',' if count else '') + json.dumps(item)
+                        count += 1
+                    remaining -= len(activities)
+                    if len(activities) < size:
+                        break
+                    batch_domain = [domain, cls.get_before_domain(
+                        cls.encode_cursor(activities[-1])
+                    )]
+                    batch_offset = 0
+                    batch_score = cls.score_from_date(
+                        activities[-1].create_date
+                    )
+
+                next_cursor = None
+                if activities and remaining == 0:
+                    next_cursor = cls.encode_cursor(activities[-1])
+                extra = dict(properties or {})
+                yield '], "totalItems": %d, "next": %s' % (
+                    extra.pop('totalItems', count), json.dumps(next_cursor)
+                )
+                for key, value in extra.iteritems():
+                    yield ', %s: %s' % (json.dumps(key), json.dumps(value))
+                yield '}'
+
+        return Response(
+            stream_with_context(generate()), mimetype='application/json'
+        )
+
+    @staticmethod
+    def get_transaction_manager():
+        '''
+        Returns a function returning a context manager to access the database
+        from the generator of a response, which is iterated once the
+        transaction of the request is over. A new transaction with the user
+        and context of the current one is started each time, unless a
+        transaction is still running like in the tests.
+        '''
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+        user, context = transaction.user, transaction.context.copy()
+
+        def transaction_manager():
+            if Transaction().cursor is None:
+                return Transaction().start(
+                    database_name, user, context=context
+                )
+            return Transaction().set_context(context)
+        return transaction_manager
+
+    @classmethod
+    def push_response(cls, domain, channels):
+        '''
+        Returns a Server-Sent Events response pushing the activities matching
+        the domain as they are created, for at most `timeout` seconds after
+        which the client is expected to reconnect.
+
+        The connection waits on the broker for a notification on any of the
+        channels and then searches the activities newer than the last one
+        sent in a new transaction, so that only the committed activities
+        the domain allows are sent. The id of each event is the cursor of
+        its newest activity, which the client sends back as Last-Event-ID
+        when reconnecting.
+        '''
+        limit = request.args.get('limit', 100, int)
+        timeout = min(
+            request.args.get('timeout', 30, int),
+            config.getint('activity_stream', 'push_max_timeout', default=300)
+        )
+        since = request.headers.get('Last-Event-ID') or \
+            request.args.get('since')
+        if since:
+            cls.decode_cursor(since)
+        else:
+            top = cls.search(domain, limit=1)
+            since = cls.encode_cursor(top[0]) if top else None
+
+        field_names = cls.get_serialize_fields()
+
+        # Subscribe before searching to not miss the activities created
+        # in between
+        subscription = activity_broker.subscribe(channels)
+        transaction_manager = cls.get_transaction_manager()
+
+        def generate():
+            deadline = time.time() + timeout
+            cursor = since
+            try:
+                yield ': %d\n\n' % timeout
+                while True:
+                    with transaction_manager():
+                        search_domain = domain
+                        if cursor:
+                            search_domain = [
+                                domain, cls.get_since_domain(cursor)
+                            ]
+                        activities = cls.search(search_domain, limit=limit)
+                        items = cls.serialize_many(activities, field_names)
+                    if activities:
+                        cursor = cls.encode_cursor(activities[0])
+                        yield 'id: %s\ndata: %s\n\n' % (cursor, json.dumps({
+                            'totalItems': len(items),
+                            'items': items,
+                            'resync': len(activities) == limit,
+                        }))
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or subscription is None:
+                        break
+                    subscription.wait(remaining)
+            finally:
+                if subscription is not None:
+                    subscription.close()
+
+        return Response(
+            stream_with_context(generate()), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache'}
+        )
+
+    @classmethod
+    def publish(cls, activities):
+        '''
+        Notify the push streams and the public window of the activities,
+        once the transaction creating them is committed.
+        '''
+        channels = set(['public'])
+        channels.update(('actor', a.actor.id) for a in activities)
+        ids = map(int, activities)
+        database_name = Transaction().cursor.database_name
+
+        after_commit(activity_broker.publish, channels, ids)
+        after_commit(public_window.notify, database_name, ids)
+
+    @classmethod
+    @route('/activity-stream')
+    def public_stream(cls):
+        '''
+        Returns activity stream for public user
+        '''
+        response = cls.public_window_response()
+        if response is not None:
+            return response
+        return cls.stream_response(cls.get_public_stream_domain())
+
+    @classmethod
+    @route('/user/activity-stream')
+    @login_required
+    def stream(cls):
+        '''
+        Return JSON Serialized Activity Stream to XHR.
+        As defined by the activity stream json specification 1.0
+        http://activitystrea.ms/specs/json/1.0/
+        '''
+        return cls.stream_response(
+            cls.get_activity_stream_domain(), cls.get_merge_actors(),
+            cls.get_timeline_user()
+        )
+
+    @classmethod
+    @route('/activity-stream/object/<model>/<int:record_id>')
+    @login_required
+    def object_stream(cls, model, record_id):
+        '''
+        Return the activity stream of the activities on the record of model
+        and record_id, with the serialization and paging of stream.
+        '''
+        return cls.reference_stream('object', model, record_id)
+
+    @classmethod
+    @route('/activity-stream/target/<model>/<int:record_id>')
+    @login_required
+    def target_stream(cls, model, record_id):
+        '''
+        Return the activity stream of the activities targeting the record of
+        model and record_id, with the serialization and paging of stream.
+        '''
+        return cls.reference_stream('target', model, record_id)
+
+    @classmethod
+    def reference_stream(cls, name, model, record_id):
+        '''
+        Return the stream response of the activities whose object or target,
+        as name, is the record and which the user could see. Aborts with a
+        404 Not Found when the model is not allowed.
+        '''
+        if model not in cls.get_allowed_models():
+            abort(404)
+        return cls.stream_response([
+            cls.get_reference_stream_visibility_domain(),
+            cls.get_reference_stream_domain(name, model, record_id),
+        ])
+
+    @classmethod
+    def get_reference_stream_visibility_domain(cls):
+        '''
+        Returns the domain of the activities the user could see in the
+        streams of an object or a target, which is the domain of the
+        activity stream of the user by default. Modules could extend this
+        to make the streams of their records public.
+        '''
+        return cls.get_activity_stream_domain()
+
+    @classmethod
+    @route('/activity-stream/push')
+    def public_push(cls):
+        '''
+        Push the public activity stream as Server-Sent Events
+        '''
+        return cls.push_response(cls.get_public_stream_domain(), ['public'])
+
+    @classmethod
+    @route('/user/activity-stream/push')
+    @login_required
+    def push(cls):
+        '''
+        Push the activity stream of the user as Server-Sent Events
+        '''
+        channels = [
+            ('actor', actor_id) for actor_id in
+            cls.get_followed_actors(request.nereid_user.id)
+        ]
+        return cls.push_response(cls.get_activity_stream_domain(), channels)
+
+
+class ActivityAllowedModel(ModelSQL, ModelView):
+    '''
+    Nereid activity allowed model
+
+    The model stores name (name) and model (ir.model) as list of allowed model
+    in activty.
+    '''
+    __name__ = 'nereid.activity.allowed_model'
+
+    name = fields.Char("Name", required=True, select=True)
+    model = fields.Many2One('ir.model', 'Model', required=True, select=True)
+    trigger = fields.Many2One(
+        'ir.trigger', 'Trigger', readonly=True, ondelete='SET NULL'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(ActivityAllowedModel, cls).__setup__()
         cls._sql_constraints += [
             ('unique_model', 'UNIQUE(model)',
                 'Name is already used.'),
             ('unique_name', 'UNIQUE(name)',
                 'Model is already used.'),
         ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(ActivityAllowedModel, cls).__register__(module_name)
+
+        # Migration from 3.4.0.1: the allowed models had no trigger, and
+        # the trigger of an allowed model could have been deleted
+        records = cls.search([('trigger', '=', None)])
+        if records:
+            cls.create_triggers(records)
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(ActivityAllowedModel, cls).create(vlist)
+        Pool().get('nereid.activity')._models_cache.clear()
+        cls.create_triggers(records)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        to_update = []
+        for records, values in zip(actions, actions):
+            if 'model' in values:
+                to_update.extend(records)
+        super(ActivityAllowedModel, cls).write(*args)
+        Pool().get('nereid.activity')._models_cache.clear()
+        if to_update:
+            cls.delete_triggers(to_update)
+            cls.create_triggers(to_update)
+
+    @classmethod
+    def delete(cls, records):
+        triggers = [r.trigger for r in records if r.trigger]
+        super(ActivityAllowedModel, cls).delete(records)
+        Pool().get('nereid.activity')._models_cache.clear()
+        with Transaction().set_user(0):
+            Pool().get('ir.trigger').delete(triggers)
+
+    @classmethod
+    def create_triggers(cls, records):
+        '''
+        Create for each allowed model a trigger deleting the activities of
+        its records when they are deleted.
+        '''
+        pool = Pool()
+        Trigger = pool.get('ir.trigger')
+        Model = pool.get('ir.model')
+
+        activity_model, = Model.search([('model', '=', 'nereid.activity')])
+        with Transaction().set_user(0):
+            triggers = Trigger.create([{
+                'name': 'Delete the activities of %s' % record.name,
+                'model': record.model.id,
+                'on_delete': True,
+                'condition': 'true',
+                'action_model': activity_model.id,
+                'action_function': 'delete_references',
+            } for record in records])
+        args = []
+        for record, trigger in zip(records, triggers):
+            args.extend(([record], {'trigger': trigger.id}))
+        if args:
+            cls.write(*args)
+
+    @classmethod
+    def delete_triggers(cls, records):
+        '''
+        Delete the triggers of the allowed models
+        '''
+        with Transaction().set_user(0):
+            Pool().get('ir.trigger').delete(
+                [r.trigger for r in records if r.trigger]
+            )
+
+
+class ActivityTimeline(ModelSQL):
+    '''
+    Nereid activity timeline
+
+    The model stores the activities fanned out on write to the timeline of
+    each nereid user subscribed to their actor, so that the activity stream
+    of a user is read from a compact table instead of scanning the
+    activities of all the actors the user follows.
+    '''
+    __name__ = 'nereid.activity.timeline'
+
+    user = fields.Many2One(
+        'nereid.user', 'User', required=True, ondelete='CASCADE'
+    )
+    activity = fields.Many2One(
+        'nereid.activity', 'Activity', required=True, ondelete='CASCADE',
+        select=True
+    )
+    score = fields.Integer('Score', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ActivityTimeline, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['user', 'activity'], 'add')
+        # Backs the timeline_search of the activity stream
+        table.index_action(['user', 'score', 'activity'], 'add')
+
+    @classmethod
+    def insert_entries(cls, entries, chunk_size=1000):
+        '''
+        Insert the timeline entries with multi-row inserts, bypassing the
+        ORM as fanning out an activity may create thousands of them.
+
+        :param entries: list of (user id, activity id, score) tuples
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        user_id = Transaction().user
+
+        for i in range(0, len(entries), chunk_size):
+            cursor.execute(*table.insert(
+                [
+                    table.user, table.activity, table.score,
+                    table.create_uid, table.create_date,
+                ],
+                [
+                    [user, activity, score, user_id, CurrentTimestamp()]
+                    for user, activity, score in entries[i:i + chunk_size]
+                ]
+            ))
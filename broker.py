@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+    broker
+
+    Publish/subscribe broker notifying the push streams of new activities.
+
+    :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import time
+from collections import deque
+from threading import Condition, Lock
+
+__all__ = [
+    'BrokerBackend', 'Subscription', 'MemoryBackend', 'ActivityBroker',
+    'activity_broker',
+]
+
+
+class Subscription(object):
+    '''
+    Subscription to some channels of a broker backend
+    '''
+
+    def wait(self, timeout):
+        '''
+        Wait at most timeout seconds for messages and return the list of
+        the messages published since the last call.
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''
+        Stop receiving messages
+        '''
+        raise NotImplementedError
+
+
+class BrokerBackend(object):
+    '''
+    Interface of the backends of the activity broker. Backends talking to
+    external services allow processes to be notified of the activities
+    created by other processes.
+    '''
+
+    def publish(self, channels, message):
+        '''
+        Send the message to the subscribers of any of the channels
+        '''
+        raise NotImplementedError
+
+    def subscribe(self, channels):
+        '''
+        Return a Subscription to the channels
+        '''
+        raise NotImplementedError
+
+
+class MemorySubscription(Subscription):
+
+    def __init__(self, backend, channels):
+        self.backend = backend
+        self.channels = channels
+        self.messages = deque()
+        self.condition = Condition()
+
+    def put(self, message):
+        with self.condition:
+            self.messages.append(message)
+            self.condition.notify()
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        with self.condition:
+            while not self.messages:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            messages = list(self.messages)
+            self.messages.clear()
+        return messages
+
+    def close(self):
+        self.backend.unsubscribe(self)
+
+
+class MemoryBackend(BrokerBackend):
+    '''
+    In process backend, which only notifies the subscribers of the
+    activities created by the same process. It is enough for single
+    process deployments and for the tests.
+    '''
+
+    def __init__(self):
+        self.subscriptions = {}
+        self._lock = Lock()
+
+    def publish(self, channels, message):
+        with self._lock:
+            subscriptions = set()
+            for channel in channels:
+                subscriptions.update(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def subscribe(self, channels):
+        subscription = MemorySubscription(self, channels)
+        with self._lock:
+            for channel in channels:
+                self.subscriptions.setdefault(
+                    channel, set()
+                ).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscriptions = self.subscriptions.get(channel, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self.subscriptions.pop(channel, None)
+
+
+class ActivityBroker(object):
+    '''
+    Broker notifying the push streams of the new activities. The channels
+    are 'public' for every activity and ('actor', id) for the activities of
+    each actor.
+    '''
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def set_backend(self, backend):
+        '''
+        Replace the backend, None disables the notifications
+        '''
+        self.backend = backend
+
+    def publish(self, channels, message):
+        if self.backend is not None:
+            self.backend.publish(channels, message)
+
+    def subscribe(self, channels):
+        if self.backend is None:
+            return None
+        return self.backend.subscribe(channels)
+
+
+activity_broker = ActivityBroker(MemoryBackend())
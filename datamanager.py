@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+    datamanager
+
+    Hooks run once the transaction is committed.
+
+    :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+
+from trytond.transaction import Transaction
+
+__all__ = ['AfterCommitDataManager', 'after_commit']
+
+logger = logging.getLogger(__name__)
+
+
+class AfterCommitDataManager(object):
+    '''
+    Data manager of a transaction calling its callbacks once the transaction
+    is committed, and dropping them when it is rolled back. A transaction
+    joins a single one, which collects all the callbacks.
+    '''
+
+    def __init__(self):
+        self.callbacks = []
+
+    def __eq__(self, other):
+        return isinstance(other, AfterCommitDataManager)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def append(self, callback, *args):
+        self.callbacks.append((callback, args))
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks:
+            # The transaction is committed, a failing callback must not
+            # prevent the others from running
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception('Callback %r failed after commit', callback)
+
+    def tpc_abort(self, trans):
+        self.callbacks = []
+
+
+def after_commit(callback, *args):
+    '''
+    Call callback with args once the current transaction is committed, or
+    never if it is rolled back.
+    '''
+    Transaction().join(AfterCommitDataManager()).append(callback, *args)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics
+
+    Instrumentation of the activity stream.
+
+    :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from trytond.transaction import Transaction
+from trytond.config import config
+
+__all__ = [
+    'MetricsSink', 'MemorySink', 'ActivityMetrics', 'activity_metrics',
+    'instrument_response',
+]
+
+
+class MetricsSink(object):
+    '''
+    Interface of the sinks of the metrics, like a StatsD or Prometheus
+    client
+    '''
+
+    def timing(self, name, seconds):
+        '''
+        Record a duration
+        '''
+        raise NotImplementedError
+
+    def increment(self, name, value=1):
+        '''
+        Add the value to a counter
+        '''
+        raise NotImplementedError
+
+
+class MemorySink(MetricsSink):
+    '''
+    Sink keeping the metrics in dictionaries, which the tests could
+    inspect.
+    '''
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+
+    def timing(self, name, seconds):
+        self.timings.setdefault(name, []).append(seconds)
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.timing(self.name, time.time() - self.start)
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class ActivityMetrics(object):
+    '''
+    Timers and counters of the activity stream, sent to the sink and
+    collected for the current request when it is instrumented. Both are
+    no-ops when there is no sink and no request is collected.
+    '''
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self._local = threading.local()
+
+    def set_sink(self, sink):
+        '''
+        Replace the sink, None disables the metrics
+        '''
+        self.sink = sink
+
+    @property
+    def collected(self):
+        return getattr(self._local, 'collected', None)
+
+    @property
+    def enabled(self):
+        return self.sink is not None or self.collected is not None
+
+    def timer(self, name):
+        '''
+        Return a context manager timing its block
+        '''
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, name)
+
+    def timing(self, name, seconds):
+        if self.sink is not None:
+            self.sink.timing(name, seconds)
+        collected = self.collected
+        if collected is not None:
+            timings = collected['timings']
+            timings[name] = timings.get(name, 0) + seconds
+
+    def increment(self, name, value=1):
+        if self.sink is not None:
+            self.sink.increment(name, value)
+        collected = self.collected
+        if collected is not None:
+            counters = collected['counters']
+            counters[name] = counters.get(name, 0) + value
+
+    @contextmanager
+    def collect(self):
+        '''
+        Collect the metrics of the block in the current thread and yield
+        the dictionary of the timings and counters.
+        '''
+        previous = self.collected
+        self._local.collected = collected = {'timings': {}, 'counters': {}}
+        try:
+            yield collected
+        finally:
+            self._local.collected = previous
+
+    @contextmanager
+    def count_queries(self, name='queries'):
+        '''
+        Count the queries executed by the cursor of the transaction in the
+        block.
+        '''
+        cursor = Transaction().cursor
+        patched = 'execute' in cursor.__dict__
+        execute = cursor.execute
+
+        def counting_execute(*args, **kwargs):
+            self.increment(name)
+            return execute(*args, **kwargs)
+
+        cursor.execute = counting_execute
+        try:
+            yield
+        finally:
+            if patched:
+                cursor.execute = execute
+            else:
+                del cursor.execute
+
+    @staticmethod
+    def format_header(collected):
+        '''
+        Return the value of the X-Activity-Timing header for the collected
+        metrics, in the syntax of Server-Timing.
+        '''
+        return ', '.join(
+            ['%s;dur=%.2f' % (name, seconds * 1000)
+                for name, seconds in sorted(collected['timings'].items())]
+            + ['%s;count=%d' % (name, value)
+                for name, value in sorted(collected['counters'].items())]
+        )
+
+
+def instrument_response(name):
+    '''
+    Decorate a method returning a response to time it as name, count its
+    queries and the size of the response. When the timing_header option of
+    the activity_stream section of the configuration is set, the collected
+    metrics are returned in the X-Activity-Timing header.
+
+    The work done while streaming the response happens once the method has
+    returned and is not part of the collected metrics.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            header = config.getboolean(
+                'activity_stream', 'timing_header', default=False
+            )
+            if activity_metrics.sink is None and not header:
+                return func(*args, **kwargs)
+
+            with activity_metrics.collect() as collected:
+                with activity_metrics.count_queries():
+                    with activity_metrics.timer(name):
+                        response = func(*args, **kwargs)
+                if response.content_length is not None:
+                    activity_metrics.increment(
+                        'bytes', response.content_length
+                    )
+            if header:
+                response.headers['X-Activity-Timing'] = \
+                    activity_metrics.format_header(collected)
+            return response
+        return wrapper
+    return decorator
+
+
+activity_metrics = ActivityMetrics()
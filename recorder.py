@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+    recorder
+
+    Background recording of the activities in batches.
+
+    :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import time
+import logging
+from Queue import Queue, Full, Empty
+from threading import Thread, Lock
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.config import config
+
+__all__ = [
+    'RecorderBackend', 'ThreadBackend', 'MemoryBackend', 'ActivityRecorder',
+    'activity_recorder', 'record_rows',
+]
+
+logger = logging.getLogger(__name__)
+
+
+def record_rows(database_name, user, context, rows):
+    '''
+    Record the rows of activities with bulk_record and commit them, in a
+    new transaction unless a transaction is still running like in the
+    tests. The new activities are published once they are committed, for
+    the push streams to find them.
+    '''
+    if Transaction().cursor is not None:
+        with Transaction().set_context(context):
+            Pool().get('nereid.activity').bulk_record(rows)
+        return
+    with Transaction().start(database_name, user, context=context) \
+            as transaction:
+        Pool().get('nereid.activity').bulk_record(rows)
+        transaction.cursor.commit()
+
+
+def group_jobs(jobs):
+    '''
+    Return the list of (database_name, user, context, rows) merging the
+    rows of the consecutive jobs of the same database, user and context,
+    so that they are recorded with a single bulk_record.
+    '''
+    groups = []
+    for database_name, user, context, rows in jobs:
+        if groups and groups[-1][:3] == (database_name, user, context):
+            groups[-1][3].extend(rows)
+        else:
+            groups.append((database_name, user, context, list(rows)))
+    return groups
+
+
+class RecorderBackend(object):
+    '''
+    Interface of the backends of the activity recorder. A job is a tuple
+    of the database name, user, context and list of rows of activities to
+    record with bulk_record.
+    '''
+
+    def put(self, job):
+        '''
+        Queue the job and return True, or return False if the backend could
+        not take it for the job to be recorded synchronously.
+        '''
+        raise NotImplementedError
+
+    def flush(self):
+        '''
+        Wait until all the queued jobs are recorded
+        '''
+        raise NotImplementedError
+
+
+class ThreadBackend(RecorderBackend):
+    '''
+    In process backend queuing at most maxsize jobs, which a worker thread
+    records by batches of up to batch_size jobs. A batch failing is
+    retried with an increasing delay before being dropped.
+    '''
+
+    def __init__(
+            self, maxsize=10000, batch_size=100, retries=3, retry_delay=1,
+            put_timeout=0.1):
+        self.queue = Queue(maxsize)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.put_timeout = put_timeout
+        self._worker = None
+        self._lock = Lock()
+
+    def start(self):
+        '''
+        Start the worker thread if it is not running
+        '''
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = Thread(target=self.run)
+                self._worker.daemon = True
+                self._worker.start()
+
+    def put(self, job):
+        self.start()
+        try:
+            # Wait a little for the worker to catch up before giving up
+            self.queue.put(job, timeout=self.put_timeout)
+        except Full:
+            return False
+        return True
+
+    def flush(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            jobs = [self.queue.get()]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                for group in group_jobs(jobs):
+                    self.record(group)
+            finally:
+                for _ in jobs:
+                    self.queue.task_done()
+
+    def record(self, group):
+        for attempt in range(self.retries + 1):
+            try:
+                record_rows(*group)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception(
+                        'Dropped %d activities of database %s',
+                        len(group[3]), group[0]
+                    )
+                    return
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+
+class MemoryBackend(RecorderBackend):
+    '''
+    Backend keeping the jobs in a list until it is flushed, which records
+    them in the calling thread. It stands in for the worker and for the
+    backends of external queues in the tests.
+    '''
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.jobs = []
+
+    def put(self, job):
+        if len(self.jobs) >= self.maxsize:
+            return False
+        self.jobs.append(job)
+        return True
+
+    def flush(self):
+        jobs, self.jobs = self.jobs, []
+        for group in group_jobs(jobs):
+            record_rows(*group)
+
+
+class ActivityRecorder(object):
+    '''
+    Recorder of the activities queued by Activity.record_async. The
+    activities are recorded synchronously when the backend is full, which
+    slows the producers down to the pace of the database, or when there is
+    no backend.
+
+    The jobs are put once the transaction of the caller is committed, so
+    the synchronous recording runs in a thread of its own, which starts a
+    new transaction, and is waited for.
+    '''
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def set_backend(self, backend):
+        '''
+        Replace the backend, None records the activities synchronously
+        '''
+        self.backend = backend
+
+    def put(self, database_name, user, context, rows):
+        job = (database_name, user, context, rows)
+        if self.backend is None or not self.backend.put(job):
+            self.record(job)
+
+    def record(self, job):
+        '''
+        Record the job synchronously in a transaction of its own
+        '''
+        def record():
+            try:
+                record_rows(*job)
+            except Exception:
+                logger.exception(
+                    'Dropped %d activities of database %s',
+                    len(job[3]), job[0]
+                )
+
+        thread = Thread(target=record)
+        thread.start()
+        thread.join()
+
+    def flush(self):
+        '''
+        Wait until all the queued activities are recorded, for the tests
+        and before shutting down.
+        '''
+        if self.backend is not None:
+            self.backend.flush()
+
+
+activity_recorder = ActivityRecorder(ThreadBackend(
+    maxsize=config.getint('activity_stream', 'queue_size', default=10000),
+    retries=config.getint('activity_stream', 'queue_retries', default=3),
+))
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+    retention
+
+    Retention policies and archive of the activities.
+
+    :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import gzip
+from datetime import datetime, timedelta, date
+
+from sql import Literal
+from sql.aggregate import Count
+from sql.functions import CurrentTimestamp
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond import backend
+from trytond.config import config
+
+from flask import json
+
+__all__ = ['ActivityRetention', 'ActivityArchive']
+
+
+class ActivityRetention(ModelSQL, ModelView):
+    '''
+    Nereid activity retention policy
+
+    The model stores how long (max_age) and how many activities per actor
+    (max_per_actor) are kept, for a verb or for all the activities when no
+    verb is set, and whether the activities beyond are deleted or archived.
+    '''
+    __name__ = 'nereid.activity.retention'
+
+    verb = fields.Char(
+        'Verb', select=True,
+        help='Leave empty to apply the policy to the verbs without a policy'
+    )
+    max_age = fields.Integer(
+        'Max Age', help='Number of days the activities are kept'
+    )
+    max_per_actor = fields.Integer(
+        'Max Activities per Actor',
+        help='Number of the most recent activities kept for each actor'
+    )
+    action = fields.Selection([
+        ('archive', 'Archive'),
+        ('archive_file', 'Archive to File'),
+        ('delete', 'Delete'),
+    ], 'Action', required=True)
+
+    @staticmethod
+    def default_action():
+        return 'archive'
+
+    @classmethod
+    def apply_policies(cls, batch_size=1000):
+        '''
+        Apply all the retention policies. This is called by the cron.
+        '''
+        for policy in cls.search([]):
+            policy.apply(batch_size)
+
+    def apply(self, batch_size=1000):
+        '''
+        Remove the activities beyond the policy, batch_size at a time. The
+        transaction is committed after each batch so that the rows are not
+        locked for long.
+        '''
+        for ids in self.get_expired_batches(batch_size):
+            self.purge(ids)
+            Transaction().cursor.commit()
+
+    def get_expired_batches(self, batch_size):
+        '''
+        Yield the lists of the ids of the activities beyond the policy,
+        oldest first. The activities yielded must be purged before the next
+        batch is asked for.
+
+        A policy without verb does not apply to the verbs which have their
+        own policy, so that these could be kept longer.
+        '''
+        Activity = Pool().get('nereid.activity')
+        cursor = Transaction().cursor
+        table = Activity.__table__()
+
+        where = Literal(True)
+        if self.verb:
+            where &= (table.verb == self.verb)
+        else:
+            verbs = list(set(
+                p.verb for p in self.search([('verb', '!=', None)])
+            ))
+            if verbs:
+                where &= ~table.verb.in_(verbs)
+
+        if self.max_age:
+            limit_date = datetime.utcnow() - timedelta(days=self.max_age)
+            while True:
+                cursor.execute(*table.select(
+                    table.id,
+                    where=where & (table.create_date < limit_date),
+                    order_by=[table.create_date.asc, table.id.asc],
+                    limit=batch_size
+                ))
+                ids = [id_ for id_, in cursor.fetchall()]
+                if not ids:
+                    break
+                yield ids
+
+        if self.max_per_actor:
+            cursor.execute(*table.select(
+                table.actor,
+                where=where,
+                group_by=[table.actor],
+                having=Count(table.id) > self.max_per_actor
+            ))
+            for actor_id, in cursor.fetchall():
+                while True:
+                    cursor.execute(*table.select(
+                        table.id,
+                        where=where & (table.actor == actor_id),
+                        order_by=[table.create_date.desc, table.id.desc],
+                        offset=self.max_per_actor, limit=batch_size
+                    ))
+                    ids = [id_ for id_, in cursor.fetchall()]
+                    if not ids:
+                        break
+                    yield ids
+
+    def purge(self, ids):
+        '''
+        Archive the activities according to the action of the policy and
+        delete them.
+        '''
+        Activity = Pool().get('nereid.activity')
+        Archive = Pool().get('nereid.activity.archive')
+
+        if self.action == 'archive':
+            Archive.archive(ids)
+        elif self.action == 'archive_file':
+            Archive.archive_to_file(ids)
+        Activity.purge(ids)
+
+
+class ActivityArchive(ModelSQL, ModelView):
+    '''
+    Nereid activity archive
+
+    The model stores the activities removed from nereid.activity by the
+    retention policies, so that the activity table only holds the recent
+    activities the streams are read from.
+    '''
+    __name__ = 'nereid.activity.archive'
+
+    activity = fields.Integer('Activity', readonly=True)
+    actor = fields.Many2One(
+        'nereid.user', 'Actor', readonly=True, ondelete='CASCADE'
+    )
+    verb = fields.Char('Verb', readonly=True)
+    object_ = fields.Char('Object', readonly=True)
+    target = fields.Char('Target', readonly=True)
+    score = fields.Integer('Score', readonly=True)
+    published = fields.DateTime('Published', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ActivityArchive, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['actor', 'published'], 'add')
+
+    @classmethod
+    def __setup__(cls):
+        super(ActivityArchive, cls).__setup__()
+        cls._order = [('published', 'DESC'), ('id', 'DESC')]
+        cls._error_messages.update({
+            'no_archive_path': (
+                'The archive_path option of the activity_stream section of '
+                'the configuration is not set.'
+            ),
+        })
+
+    @classmethod
+    def archive(cls, ids):
+        '''
+        Copy the activities to the archive with a single insert
+        '''
+        Activity = Pool().get('nereid.activity')
+        transaction = Transaction()
+        table = Activity.__table__()
+        archive = cls.__table__()
+
+        transaction.cursor.execute(*archive.insert(
+            [
+                archive.activity, archive.actor, archive.verb,
+                archive.object_, archive.target, archive.score,
+                archive.published, archive.create_uid, archive.create_date,
+            ],
+            table.select(
+                table.id, table.actor, table.verb, table.object_,
+                table.target, table.score, table.create_date,
+                Literal(transaction.user), CurrentTimestamp(),
+                where=table.id.in_(ids)
+            )
+        ))
+
+    @classmethod
+    def archive_to_file(cls, ids):
+        '''
+        Append the activities as JSON lines to the compressed file of the
+        day in the directory set by the archive_path option of the
+        activity_stream section of the configuration.
+        '''
+        Activity = Pool().get('nereid.activity')
+        cursor = Transaction().cursor
+        table = Activity.__table__()
+
+        path = config.get('activity_stream', 'archive_path')
+        if not path:
+            cls.raise_user_error('no_archive_path')
+
+        cursor.execute(*table.select(
+            table.id, table.actor, table.verb, table.object_, table.target,
+            table.score, table.create_date,
+            where=table.id.in_(ids), order_by=[table.id.asc]
+        ))
+        filename = os.path.join(path, '%s-%s.jsonl.gz' % (
+            cursor.database_name, date.today().isoformat()
+        ))
+        archive_file = gzip.open(filename, 'ab')
+        try:
+            for id_, actor, verb, object_, target, score, create_date \
+                    in cursor.fetchall():
+                archive_file.write(json.dumps({
+                    'activity': id_,
+                    'actor': actor,
+                    'verb': verb,
+                    'object_': object_,
+                    'target': target,
+                    'score': score,
+                    'published': create_date.isoformat(),
+                }) + '\n')
+        finally:
+            archive_file.close()
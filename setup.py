@@ -101,6 +101,9 @@ setup(
     ],
     license='GPLv3',
     install_requires=requires,
+    extras_require={
+        'msgpack': ['msgpack-python'],
+    },
     zip_safe=False,
     entry_points="""
     [trytond.modules]
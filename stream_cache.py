@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+    stream_cache
+
+    Caches of the activity stream.
+
+    :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import copy
+import time
+from collections import deque
+from threading import Lock
+
+from trytond.cache import Cache, LRUDict
+from trytond.config import config
+
+__all__ = [
+    'CacheBackend', 'LRUBackend', 'DictBackend', 'SerializedActivityCache',
+    'serialized_cache', 'StatsCache', 'StreamWindow', 'public_window',
+]
+
+_MISSING = object()
+
+
+class StatsCache(Cache):
+    '''
+    Tryton cache counting its hits and misses in the current process
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(StatsCache, self).__init__(*args, **kwargs)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        result = super(StatsCache, self).get(key, _MISSING)
+        if result is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return result
+
+
+class CacheBackend(object):
+    '''
+    Interface of the backends of the serialized activity cache. A backend
+    is a key value store and only has to implement the bulk operations
+    below, which allows backends talking to external services to do a
+    single round trip per page of activities.
+    '''
+
+    def get_many(self, keys):
+        '''
+        Return a dictionary of the values found for the given keys
+        '''
+        raise NotImplementedError
+
+    def set_many(self, mapping):
+        '''
+        Store the values of the dictionary
+        '''
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        '''
+        Remove the given keys
+        '''
+        raise NotImplementedError
+
+    def clear(self):
+        '''
+        Remove all the keys
+        '''
+        raise NotImplementedError
+
+
+class LRUBackend(CacheBackend):
+    '''
+    In process backend keeping the most recently used entries
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._data = LRUDict(size)
+        self._lock = Lock()
+
+    def get_many(self, keys):
+        result = {}
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    # Set the value again to mark it as recently used
+                    self._data[key] = result[key] = self._data.pop(key)
+        return result
+
+    def set_many(self, mapping):
+        with self._lock:
+            for key, value in mapping.iteritems():
+                self._data.pop(key, None)
+                self._data[key] = value
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DictBackend(CacheBackend):
+    '''
+    Unbounded backend storing the entries in a plain dictionary, which the
+    tests could inspect. It stands in for the backends of external
+    services.
+    '''
+
+    def __init__(self):
+        self.data = {}
+
+    def get_many(self, keys):
+        return dict((k, self.data[k]) for k in keys if k in self.data)
+
+    def set_many(self, mapping):
+        self.data.update(mapping)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+
+class SerializedActivityCache(object):
+    '''
+    Cache of the serialized activities keyed by the database and the id of
+    the activity.
+
+    Each entry is stored with the version of the records it was built from
+    (and the language it was built in), and is only returned if the version
+    is still the same, so that changes to the activity, actor, object or
+    target made by other processes are never served stale.
+    '''
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def set_backend(self, backend):
+        '''
+        Replace the backend, None disables the cache
+        '''
+        self.backend = backend
+
+    def get_many(self, database_name, versions):
+        '''
+        Return a dictionary of the serialized activities which are cached
+        with the given version.
+
+        :param versions: dictionary of activity id and version
+        '''
+        if self.backend is None or not versions:
+            return {}
+        result = {}
+        cached = self.backend.get_many(
+            [(database_name, id_) for id_ in versions]
+        )
+        for (_, id_), (version, value) in cached.iteritems():
+            if version == versions[id_]:
+                # The value is copied as callers are allowed to inject
+                # properties in the serialized activity
+                result[id_] = copy.deepcopy(value)
+        return result
+
+    def set_many(self, database_name, values):
+        '''
+        Store the serialized activities.
+
+        :param values: dictionary of activity id and (version, value)
+        '''
+        if self.backend is None or not values:
+            return
+        self.backend.set_many(dict(
+            ((database_name, id_), (version, copy.deepcopy(value)))
+            for id_, (version, value) in values.iteritems()
+        ))
+
+    def invalidate(self, database_name, ids):
+        '''
+        Remove the cached activities
+        '''
+        if self.backend is None or not ids:
+            return
+        self.backend.delete_many([(database_name, id_) for id_ in ids])
+
+    def clear(self):
+        '''
+        Remove all the cached activities
+        '''
+        if self.backend is not None:
+            self.backend.clear()
+
+
+serialized_cache = SerializedActivityCache(LRUBackend(
+    config.getint('activity_stream', 'cache_size', default=10000)
+))
+
+
+class StreamWindow(object):
+    '''
+    Ring buffer of the newest serialized activities of a stream, so that
+    its first pages are served from memory.
+
+    A window is kept per key (database, language and domain of the stream)
+    with the total of the stream, and expires after ttl seconds to bound
+    the staleness of the windows of the processes which did not see the
+    activities being changed. The ids of the new activities are noted by
+    notify and added to the windows by their next reader. Windows with more
+    than size new activities are dropped.
+    '''
+
+    def __init__(self, size=0, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._windows = {}
+        self._lock = Lock()
+
+    def configure(self, size, ttl):
+        '''
+        Change the size and ttl of the windows, a size of 0 disables them
+        '''
+        with self._lock:
+            self.size = size
+            self.ttl = ttl
+            self._windows.clear()
+
+    def get(self, key):
+        '''
+        Return the window of the key or None if it is not loaded or has
+        expired. The window is a dictionary with the entries as a list of
+        (cursor, create_date, item) newest first, the total and estimated
+        count of the stream and the list of the pending ids of the new
+        activities, which are removed from the window.
+        '''
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                return None
+            if time.time() - window['loaded'] > self.ttl:
+                del self._windows[key]
+                return None
+            pending, window['pending'] = window['pending'], []
+            return {
+                'entries': list(window['entries']),
+                'total': window['total'],
+                'estimated': window['estimated'],
+                'pending': pending,
+            }
+
+    def load(self, key, entries, total, estimated):
+        '''
+        Store the window of the key
+
+        :param entries: list of (cursor, create_date, item) newest first
+        '''
+        now = time.time()
+        with self._lock:
+            for other_key, window in self._windows.items():
+                if now - window['loaded'] > self.ttl:
+                    del self._windows[other_key]
+            self._windows[key] = {
+                'entries': deque(entries[:self.size], maxlen=self.size),
+                'total': total,
+                'estimated': estimated,
+                'loaded': now,
+                'pending': [],
+            }
+
+    def prepend(self, key, entries, count):
+        '''
+        Add the entries of new activities to the window of the key, the
+        oldest entries being pushed out of it.
+
+        :param entries: list of (cursor, create_date, item) newest first
+        :param count: number of new activities of the stream
+        '''
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                return
+            window['entries'].extendleft(reversed(entries))
+            window['total'] += count
+
+    def notify(self, database_name, ids):
+        '''
+        Note the ids of new activities of the database for the windows to
+        be updated by their next reader.
+        '''
+        with self._lock:
+            for key, window in self._windows.items():
+                if key[0] != database_name:
+                    continue
+                window['pending'].extend(ids)
+                if len(window['pending']) > self.size:
+                    del self._windows[key]
+
+    def clear(self, database_name=None):
+        '''
+        Drop the windows of the database or all the windows
+        '''
+        with self._lock:
+            for key in self._windows.keys():
+                if database_name is None or key[0] == database_name:
+                    del self._windows[key]
+
+
+public_window = StreamWindow(
+    config.getint('activity_stream', 'public_window_size', default=0),
+    config.getint('activity_stream', 'public_window_ttl', default=60),
+)
@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark activity
+
+    The benchmarks are not part of the test suite, run them with:
+
+        python -m trytond.modules.nereid_activity_stream.tests.benchmark
+
+    The size of the data set is set by the environment:
+
+        BENCHMARK_ROWS: number of activities (10000)
+        BENCHMARK_ACTORS: number of actors (100)
+        BENCHMARK_MODELS: number of models of the objects and targets (2),
+            at most 5
+        BENCHMARK_SAMPLES: number of measures per operation (100)
+        BENCHMARK_SEED: seed of the generated data set (42)
+
+    The results are written as JSON to BENCHMARK_OUTPUT if set, and compared
+    to the results of BENCHMARK_BASELINE if set, the benchmark failing when
+    a latency regresses by more than BENCHMARK_TOLERANCE (0.2 = 20%).
+
+    :copyright: (c) 2013-2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import json
+import math
+import time
+import random
+import bisect
+import unittest
+from datetime import datetime
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, CONTEXT, USER, DB_NAME
+from trytond.transaction import Transaction
+from trytond import backend
+
+from nereid.testing import NereidTestCase
+from trytond.modules.nereid_activity_stream.stream_cache import \
+    serialized_cache
+from trytond.modules.nereid_activity_stream.metrics import activity_metrics
+
+ROWS = int(os.environ.get('BENCHMARK_ROWS', 10000))
+ACTORS = int(os.environ.get('BENCHMARK_ACTORS', 100))
+MODELS = int(os.environ.get('BENCHMARK_MODELS', 2))
+SAMPLES = int(os.environ.get('BENCHMARK_SAMPLES', 100))
+SEED = int(os.environ.get('BENCHMARK_SEED', 42))
+OUTPUT = os.environ.get('BENCHMARK_OUTPUT')
+BASELINE = os.environ.get('BENCHMARK_BASELINE')
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 0.2))
+
+# Verbs and their relative frequencies
+VERBS = [
+    ('Liked', 50),
+    ('Commented', 25),
+    ('Shared', 15),
+    ('Followed', 7),
+    ('Joined', 3),
+]
+
+
+class WeightedChoice(object):
+    '''
+    Pick items at random according to their weights
+    '''
+
+    def __init__(self, rng, items, weights):
+        self.rng = rng
+        self.items = items
+        self.cumulative = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+
+    @classmethod
+    def zipf(cls, rng, items, exponent=1.1):
+        '''
+        Pick the items with the long tail distribution of the activity of
+        the users and the popularity of the content, the first items being
+        the most frequent.
+        '''
+        return cls(rng, items, [
+            1.0 / (rank ** exponent) for rank in range(1, len(items) + 1)
+        ])
+
+    def __call__(self):
+        index = bisect.bisect(
+            self.cumulative, self.rng.random() * self.cumulative[-1]
+        )
+        return self.items[min(index, len(self.items) - 1)]
+
+
+def percentile(values, percent):
+    '''
+    Return the nearest rank percentile of the values
+    '''
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class ActivityBenchmark(NereidTestCase):
+    '''
+    Benchmark Nereid Activity
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_activity_stream')
+        self.Activity = POOL.get('nereid.activity')
+        self.Party = POOL.get('party.party')
+        self.Company = POOL.get('company.company')
+        self.NereidUser = POOL.get('nereid.user')
+        self.Currency = POOL.get('currency.currency')
+        self.ActivityAllowedModel = POOL.get('nereid.activity.allowed_model')
+        self.Model = POOL.get('ir.model')
+        self.Language = POOL.get('ir.lang')
+        self.NereidWebsite = POOL.get('nereid.website')
+        self.Locale = POOL.get('nereid.website.locale')
+        self.results = {}
+
+    def setup_defaults(self):
+        '''
+        Create an actor and allow parties as object
+        '''
+        usd, = self.Currency.create([{
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        }])
+        company_party, actor_party = self.Party.create([{
+            'name': 'Openlabs',
+        }, {
+            'name': 'Actor',
+        }])
+        company, = self.Company.create([{
+            'party': company_party.id,
+            'currency': usd.id
+        }])
+        self.actor, = self.NereidUser.create([{
+            'party': actor_party.id,
+            'company': company.id,
+            'display_name': actor_party.name,
+        }])
+        self.object_ = company_party
+        self.company = company
+        self.usd = usd
+
+        party_model, = self.Model.search([
+            ('model', '=', 'party.party')
+        ], limit=1)
+        self.ActivityAllowedModel.create([{
+            'name': 'Party',
+            'model': party_model,
+        }])
+
+    def report(self, name, rows, duration):
+        print('\n%s: %d rows in %.2fs (%.0f rows/s)' % (
+            name, rows, duration, rows / duration
+        ))
+
+    def setup_website(self):
+        '''
+        Create the website serving the streams
+        '''
+        en_us, = self.Language.search([('code', '=', 'en_US')], limit=1)
+        locale, = self.Locale.create([{
+            'code': 'en_US',
+            'language': en_us.id,
+            'currency': self.usd.id,
+        }])
+        self.NereidWebsite.create([{
+            'name': 'localhost',
+            'company': self.company.id,
+            'application_user': USER,
+            'default_locale': locale.id,
+            'currencies': [('add', [self.usd.id])],
+        }])
+
+    def create_records(self, model, parties):
+        '''
+        Create and return ACTORS records of the model, for the activities
+        of the data set to be spread on MODELS models.
+        '''
+        Model = POOL.get(model)
+        if model == 'party.address':
+            return Model.create([{
+                'party': party.id,
+                'name': 'Address %d' % i,
+            } for i, party in enumerate(parties)])
+        elif model == 'party.contact_mechanism':
+            return Model.create([{
+                'party': party.id,
+                'type': 'email',
+                'value': 'contact%d@example.com' % i,
+            } for i, party in enumerate(parties)])
+        elif model == 'party.category':
+            return Model.create([{
+                'name': 'Category %d' % i,
+            } for i in range(ACTORS)])
+        raise ValueError(model)
+
+    def populate(self, rng, chunk_size=10000):
+        '''
+        Create ACTORS actors and ROWS activities of them on the records of
+        MODELS allowed models, the actors, verbs, objects and targets
+        following realistic distributions. Returns the list of the actors.
+        '''
+        parties = self.Party.create([{
+            'name': 'Actor %d' % i,
+        } for i in range(ACTORS)])
+        actors = self.NereidUser.create([{
+            'party': party.id,
+            'company': self.company.id,
+            'display_name': party.name,
+            'email': 'actor%d@example.com' % i,
+            'password': 'password',
+        } for i, party in enumerate(parties)])
+
+        # Parties are allowed by setup_defaults
+        records = {
+            'nereid.user': actors,
+            'party.party': parties,
+        }
+        models = [
+            'nereid.user', 'party.party', 'party.address',
+            'party.contact_mechanism', 'party.category',
+        ][:max(MODELS, 1)]
+        for model in models:
+            Model = POOL.get(model)
+            if model not in records:
+                records[model] = self.create_records(model, parties)
+            if model != 'party.party':
+                ir_model, = self.Model.search([('model', '=', model)])
+                self.ActivityAllowedModel.create([{
+                    'name': ir_model.name,
+                    'model': ir_model.id,
+                }])
+            # The streams serialize the objects and targets
+            if not hasattr(Model, 'serialize'):
+                Model.serialize = lambda record, purpose=None: {
+                    'objectType': record.__name__,
+                    'id': record.id,
+                }
+                self.addCleanup(delattr, Model, 'serialize')
+        references = [
+            '%s,%d' % (model, record.id)
+            for model in models for record in records[model]
+        ]
+        rng.shuffle(references)
+
+        pick_actor = WeightedChoice.zipf(rng, actors)
+        pick_reference = WeightedChoice.zipf(rng, references)
+        pick_verb = WeightedChoice(
+            rng, [v for v, _ in VERBS], [w for _, w in VERBS]
+        )
+
+        start = time.time()
+        for i in range(0, ROWS, chunk_size):
+            self.Activity.bulk_record([{
+                'actor': pick_actor().id,
+                'verb': pick_verb(),
+                'object_': pick_reference(),
+                'target': pick_reference() if rng.random() < 0.2 else None,
+            } for _ in range(min(chunk_size, ROWS - i))])
+        self.report('populate', ROWS, time.time() - start)
+        if backend.name() == 'postgresql':
+            Transaction().cursor.execute('ANALYZE nereid_activity')
+        return actors
+
+    def measure(self, name, func):
+        '''
+        Call func SAMPLES times with the index of the sample and store the
+        p50 and p99 of its latency and the mean of its queries.
+        '''
+        durations, queries = [], []
+        for i in range(SAMPLES):
+            with activity_metrics.collect() as collected:
+                with activity_metrics.count_queries():
+                    start = time.time()
+                    func(i)
+                    durations.append(time.time() - start)
+            queries.append(collected['counters'].get('queries', 0))
+        self.results[name] = {
+            'p50_ms': percentile(durations, 50) * 1000,
+            'p99_ms': percentile(durations, 99) * 1000,
+            'queries': float(sum(queries)) / len(queries),
+        }
+        print('\n%s: p50 %.2fms, p99 %.2fms, %.1f queries' % (
+            name, self.results[name]['p50_ms'],
+            self.results[name]['p99_ms'], self.results[name]['queries'],
+        ))
+
+    def save_results(self):
+        '''
+        Write the results to OUTPUT and compare them to BASELINE
+        '''
+        results = {
+            'date': datetime.utcnow().isoformat(),
+            'backend': backend.name(),
+            'rows': ROWS,
+            'actors': ACTORS,
+            'models': MODELS,
+            'samples': SAMPLES,
+            'seed': SEED,
+            'results': self.results,
+        }
+        if OUTPUT:
+            with open(OUTPUT, 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        if not BASELINE:
+            return
+
+        with open(BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = []
+        for name, result in sorted(self.results.items()):
+            previous = baseline['results'].get(name)
+            if previous is None:
+                continue
+            for key in ('p50_ms', 'p99_ms'):
+                ratio = result[key] / max(previous[key], 0.001)
+                print('%s %s: %.2fms -> %.2fms (%+.0f%%)' % (
+                    name, key, previous[key], result[key],
+                    (ratio - 1) * 100
+                ))
+                if ratio > 1 + TOLERANCE:
+                    regressions.append('%s %s' % (name, key))
+        self.assertEqual(regressions, [], 'Regressions: %s' % regressions)
+
+    def explain(self, domain, limit=100):
+        '''
+        Return the query plan of the stream search on the domain, on
+        PostgreSQL only.
+        '''
+        if backend.name() != 'postgresql':
+            return None
+        cursor = Transaction().cursor
+        query, params = tuple(self.Activity.search(
+            domain, limit=limit, query=True
+        ))
+        cursor.execute('EXPLAIN ' + query, params)
+        return '\n'.join(line for line, in cursor.fetchall())
+
+    def test0010_bulk_record(self):
+        '''
+        Compare the throughput of bulk_record with create
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            rows = [{
+                'verb': 'Added a new friend',
+                'actor': self.actor.id,
+                'object_': 'party.party,%d' % self.object_.id,
+            } for i in range(ROWS)]
+
+            start = time.time()
+            self.Activity.create(rows)
+            self.report('create', ROWS, time.time() - start)
+
+            start = time.time()
+            self.Activity.bulk_record(rows)
+            self.report('bulk_record', ROWS, time.time() - start)
+
+    def test0020_filters(self):
+        '''
+        Time the filtered stream queries and check they use the composite
+        index of their filter
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            parties = self.Party.create([{
+                'name': 'Actor %d' % i,
+            } for i in range(20)])
+            actors = self.NereidUser.create([{
+                'party': party.id,
+                'company': self.company.id,
+                'display_name': party.name,
+            } for party in parties])
+            user_model, = self.Model.search([('model', '=', 'nereid.user')])
+            self.ActivityAllowedModel.create([{
+                'name': user_model.name,
+                'model': user_model.id,
+            }])
+            # Each filter selects 5% of the activities or less, for the
+            # planner to prefer its index to a scan of the stream order
+            verbs = ['Verb %d' % i for i in range(20)]
+            self.Activity.bulk_record([{
+                'verb': verbs[i % len(verbs)],
+                'actor': actors[i % len(actors)].id,
+                'object_': 'nereid.user,%d' % actors[i % len(actors)].id
+                if i % 20 == 0
+                else 'party.party,%d' % parties[i % len(parties)].id,
+                'target': 'party.party,%d' % parties[i % len(parties)].id
+                if i % 2 == 0 else None,
+            } for i in range(ROWS)])
+            if backend.name() == 'postgresql':
+                Transaction().cursor.execute('ANALYZE nereid_activity')
+
+            for name, domain, index in [
+                    ('verb', [('verb', '=', verbs[3])], 'verb_create_date'),
+                    ('object', [('object_model', '=', 'nereid.user')],
+                        'object_model_create_date'),
+                    ('actor', [('actor', '=', actors[3].id)],
+                        'actor_create_date'),
+                    ('target', self.Activity.get_reference_stream_domain(
+                        'target', 'party.party', parties[4].id
+                    ), 'target_model_target_id_create_date'),
+                    ]:
+                start = time.time()
+                self.Activity.search(domain, limit=100)
+                print('\nfilter %s: %.2fms' % (
+                    name, (time.time() - start) * 1000
+                ))
+                plan = self.explain(domain)
+                if plan is not None:
+                    print(plan)
+                    self.assertIn('nereid_activity_%s_index' % index, plan)
+
+    def test0030_streams(self):
+        '''
+        Measure the latency and queries of the streams, the serialization
+        and the creation of the activities on a generated data set
+        '''
+        # Nothing is public by default, make all the activities public for
+        # the public stream to serve them
+        self.Activity.get_public_stream_domain = classmethod(lambda cls: [])
+        self.addCleanup(
+            delattr, self.Activity, 'get_public_stream_domain'
+        )
+        rng = random.Random(SEED)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.setup_website()
+            actors = self.populate(rng)
+            app = self.get_app()
+
+            clients = {}
+
+            def client(actor):
+                if actor.id not in clients:
+                    clients[actor.id] = c = app.test_client()
+                    rv = c.post('/login', data={
+                        'email': actor.email,
+                        'password': 'password',
+                    })
+                    self.assertEqual(rv.status_code, 302)
+                return clients[actor.id]
+
+            def public_stream(i):
+                rv = app.test_client().get('/activity-stream')
+                self.assertEqual(rv.status_code, 200)
+                self.assertTrue(json.loads(rv.data)['items'])
+            self.measure('public_stream', public_stream)
+
+            pick_actor = WeightedChoice.zipf(rng, actors)
+            stream_actors = [pick_actor() for _ in range(SAMPLES)]
+            for actor in stream_actors:
+                client(actor)
+
+            def stream(i):
+                rv = client(stream_actors[i]).get('/user/activity-stream')
+                self.assertEqual(rv.status_code, 200)
+            self.measure('stream', stream)
+
+            ids = map(int, self.Activity.search([], limit=SAMPLES * 100))
+            pages = [
+                self.Activity.browse(rng.sample(ids, min(100, len(ids))))
+                for _ in range(SAMPLES)
+            ]
+
+            def serialize(i):
+                serialized_cache.clear()
+                self.Activity.serialize_many(pages[i])
+            self.measure('serialize', serialize)
+
+            def create(i):
+                self.Activity.create([{
+                    'actor': stream_actors[i].id,
+                    'verb': 'Liked',
+                    'object_': 'nereid.user,%d' % actors[0].id,
+                }])
+            self.measure('create', create)
+
+            self.save_results()
+
+
+def suite():
+    '''
+    Benchmark Suite
+    '''
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        ActivityBenchmark)
+    )
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -7,7 +7,11 @@
 """
 import sys
 import json
+import calendar
+import zlib
 import os
+import time
+from datetime import timedelta
 DIR = os.path.abspath(os.path.normpath(
     os.path.join(__file__, '..', '..', '..', '..', '..', 'trytond')
 ))
@@ -21,8 +25,23 @@ from trytond.tests.test_tryton import test_view, test_depends
 from trytond.tests.test_tryton import POOL, CONTEXT, USER, DB_NAME
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
+from trytond.config import config
 
 from nereid.testing import NereidTestCase
+from trytond.modules.nereid_activity_stream.stream_cache import \
+    serialized_cache, DictBackend, public_window
+from trytond.modules.nereid_activity_stream.broker import \
+    activity_broker, MemoryBackend
+from trytond.modules.nereid_activity_stream import recorder
+from trytond.modules.nereid_activity_stream.datamanager import \
+    AfterCommitDataManager
+from trytond.modules.nereid_activity_stream.metrics import \
+    activity_metrics, MemorySink
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class ActivityTestCase(NereidTestCase):
@@ -139,6 +158,14 @@ class ActivityTestCase(NereidTestCase):
             'display_name': nereid_user.rec_name
         }])
 
+    def commit_hooks(self):
+        '''
+        Run the after commit callbacks of the transaction as if it was
+        committed, which the tests do not do to keep the database clean
+        '''
+        transaction = Transaction()
+        transaction.join(AfterCommitDataManager()).tpc_finish(transaction)
+
     def test0010_create_activity(self):
         '''
         Creates allowed activity model and activity.
@@ -198,6 +225,385 @@ class ActivityTestCase(NereidTestCase):
                 activity in self.nereid_user_actor.activities
             )
 
+            # Score is stored on create and could be searched
+            self.assertEqual(
+                activity.score,
+                calendar.timegm(activity.create_date.timetuple())
+            )
+            self.assert_(activity in self.Activity.search([
+                ('score', '>=', activity.score),
+            ], order=[('score', 'DESC')]))
+
+    def test0036_bulk_record(self):
+        '''
+        Record activities in bulk
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            party_model, = self.Model.search([
+                ('model', '=', 'party.party')
+            ], limit=1)
+            self.ActivityAllowedModel.create([{
+                'name': 'Party',
+                'model': party_model,
+            }])
+
+            ids = self.Activity.bulk_record([{
+                'verb': 'Added a new friend',
+                'actor': self.nereid_user_actor,
+                'object_': self.user_party,
+            }, {
+                'verb': 'Added a new friend',
+                'actor': self.nereid_user_actor.id,
+                'object_': 'party.party,%s' % self.user_party.id,
+                'target': 'party.party,%s' % self.user_party.id,
+            }] * 3, chunk_size=4)
+            self.assertEqual(len(ids), 6)
+
+            activities = self.Activity.browse(ids)
+            self.assertEqual(activities[0].object_, self.user_party)
+            self.assertEqual(activities[1].target, self.user_party)
+            self.assertEqual(
+                [activity.score for activity in activities],
+                [
+                    self.Activity.score_from_date(activity.create_date)
+                    for activity in activities
+                ]
+            )
+
+            # Activity without verb
+            self.assertRaises(
+                UserError, self.Activity.bulk_record, [{
+                    'actor': self.nereid_user_actor,
+                    'object_': self.user_party,
+                }]
+            )
+
+            # Activity on a model which is not allowed
+            self.assertRaises(
+                UserError, self.Activity.bulk_record, [{
+                    'verb': 'Added a new friend',
+                    'actor': self.nereid_user_actor,
+                    'object_': self.nereid_user_actor,
+                }]
+            )
+
+    def test0042_retention(self):
+        '''
+        Archive the activities beyond the retention policies
+        '''
+        Retention = POOL.get('nereid.activity.retention')
+        Archive = POOL.get('nereid.activity.archive')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            party_model, = self.Model.search([
+                ('model', '=', 'party.party')
+            ], limit=1)
+            self.ActivityAllowedModel.create([{
+                'name': 'Party',
+                'model': party_model,
+            }])
+            values = {
+                'verb': 'Added a new friend',
+                'actor': self.nereid_user_actor,
+                'object_': 'party.party,%s' % self.user_party.id,
+            }
+            self.Activity.create([values] * 3)
+            self.Activity.create([dict(values, verb='Liked')])
+
+            policy, = Retention.create([{
+                'verb': 'Added a new friend',
+                'max_per_actor': 1,
+            }])
+            for ids in policy.get_expired_batches(batch_size=1):
+                self.assertEqual(len(ids), 1)
+                policy.purge(ids)
+
+            self.assertEqual(
+                sorted(a.verb for a in self.Activity.search([])),
+                ['Added a new friend', 'Liked']
+            )
+            archived = Archive.search([])
+            self.assertEqual(len(archived), 2)
+            self.assertEqual(archived[0].actor, self.nereid_user_actor)
+            self.assertEqual(
+                archived[0].object_, 'party.party,%s' % self.user_party.id
+            )
+
+            # Nothing is older than a day
+            policy.max_per_actor = None
+            policy.max_age = 1
+            policy.save()
+            self.assertEqual(list(policy.get_expired_batches(10)), [])
+
+            # The global policies do not apply to the verbs with a policy
+            global_policy, = Retention.create([{
+                'max_per_actor': 1,
+                'action': 'delete',
+            }])
+            self.assertEqual(list(global_policy.get_expired_batches(10)), [])
+
+            # The hot domain is stable from one request to the next
+            if not config.has_section('activity_stream'):
+                config.add_section('activity_stream')
+            config.set('activity_stream', 'hot_days', '7')
+            self.addCleanup(
+                config.remove_option, 'activity_stream', 'hot_days'
+            )
+            self.assertEqual(
+                self.Activity.get_hot_domain(), self.Activity.get_hot_domain()
+            )
+
+    def test0043_dangling_references(self):
+        '''
+        Remove the activities whose object or target does not exist
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            party_model, = self.Model.search([
+                ('model', '=', 'party.party')
+            ], limit=1)
+            self.ActivityAllowedModel.create([{
+                'name': 'Party',
+                'model': party_model,
+            }])
+
+            party, = self.Party.create([{'name': 'Deleted'}])
+            kept, missing, deleted = self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.nereid_user_actor,
+                'object_': 'party.party,%s' % self.user_party.id,
+            }, {
+                'verb': 'Added a new friend',
+                'actor': self.nereid_user_actor,
+                'object_': 'party.party,%s' % self.user_party.id,
+                'target': 'party.party,%s' % (party.id + 1000),
+            }, {
+                'verb': 'Added a new friend',
+                'actor': self.nereid_user_actor,
+                'object_': 'party.party,%s' % party.id,
+            }])
+
+            # The trigger of the allowed model removes the activities
+            self.Party.delete([party])
+            self.assertEqual(
+                self.Activity.search([]), [missing, kept]
+            )
+
+            self.Activity.purge_dangling()
+            self.assertEqual(self.Activity.search([]), [kept])
+
+    def test0049_record_async(self):
+        '''
+        Record the activities in the background
+        '''
+        backend = recorder.MemoryBackend(maxsize=2)
+        self.addCleanup(
+            recorder.activity_recorder.set_backend,
+            recorder.activity_recorder.backend
+        )
+        recorder.activity_recorder.set_backend(backend)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            object_ = 'nereid.user,%s' % self.nereid_user_actor.id
+
+            self.assertRaises(
+                UserError, self.Activity.record_async,
+                self.registered_user, 'Added a new friend', 'ir.model,1'
+            )
+
+            self.Activity.record_async(
+                self.registered_user, 'Added a new friend', object_
+            )
+            self.Activity.record_async(
+                self.registered_user.id, 'Added a new friend',
+                self.nereid_user_actor, self.registered_user
+            )
+            # Queued once the transaction is committed
+            self.assertEqual(backend.jobs, [])
+            self.commit_hooks()
+            self.assertEqual(len(backend.jobs), 2)
+            self.assertEqual(self.Activity.search([], count=True), 0)
+
+            # The queue is full, the activity is recorded synchronously in
+            # a transaction of its own, which the test could not see
+            record_rows, recorded = recorder.record_rows, []
+            self.addCleanup(setattr, recorder, 'record_rows', record_rows)
+            recorder.record_rows = lambda *job: recorded.append(job[3])
+            self.Activity.record_async(
+                self.registered_user, 'Liked', object_
+            )
+            self.commit_hooks()
+            self.assertEqual(
+                [rows[0]['verb'] for rows in recorded], ['Liked']
+            )
+            self.assertEqual(len(backend.jobs), 2)
+            recorder.record_rows = record_rows
+
+            recorder.activity_recorder.flush()
+            self.assertEqual(backend.jobs, [])
+            activities = self.Activity.search([])
+            self.assertEqual(len(activities), 2)
+            self.assertEqual(
+                set(a.target for a in activities),
+                set([None, self.registered_user])
+            )
+
+            recorder.activity_recorder.set_backend(None)
+            recorder.record_rows = lambda *job: recorded.append(job[3])
+            self.Activity.record_async(
+                self.registered_user, 'Liked', object_
+            )
+            self.commit_hooks()
+            self.assertEqual(len(recorded), 2)
+            recorder.record_rows = record_rows
+
+            # Nothing is queued when the caller rolls back
+            recorder.activity_recorder.set_backend(backend)
+            self.Activity.record_async(
+                self.registered_user, 'Liked', object_
+            )
+            Transaction().cursor.rollback()
+            self.commit_hooks()
+            self.assertEqual(backend.jobs, [])
+
+        self.assertEqual(recorder.group_jobs([
+            ('db', 1, {}, [{'verb': 'a'}]),
+            ('db', 1, {}, [{'verb': 'b'}]),
+            ('db', 2, {}, [{'verb': 'c'}]),
+        ]), [
+            ('db', 1, {}, [{'verb': 'a'}, {'verb': 'b'}]),
+            ('db', 2, {}, [{'verb': 'c'}]),
+        ])
+
+    def test0052_deduplication(self):
+        '''
+        Do not record an activity twice within the dedup interval
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            values = {
+                'verb': 'Added a new friend',
+                'actor': self.registered_user.id,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            }
+
+            # Disabled by default
+            first, second = self.Activity.create([values, values])
+            self.assertNotEqual(first, second)
+            self.assertEqual(first.dedup_key, None)
+            self.Activity.delete([first, second])
+
+            if not config.has_section('activity_stream'):
+                config.add_section('activity_stream')
+            config.set('activity_stream', 'dedup_interval', '3600')
+            self.addCleanup(
+                config.remove_option, 'activity_stream', 'dedup_interval'
+            )
+
+            first, second = self.Activity.create([values, values])
+            self.assertEqual(first, second)
+            self.assertTrue(first.dedup_key)
+            activity, = self.Activity.create([values])
+            self.assertEqual(activity, first)
+            other, = self.Activity.create([dict(values, verb='Liked')])
+            self.assertNotEqual(other, first)
+            self.assertEqual(self.Activity.search([], count=True), 2)
+
+            ids = self.Activity.bulk_record([
+                dict(values, object_=self.nereid_user_actor),
+                dict(values, verb='Commented'),
+                dict(values, verb='Commented'),
+            ])
+            self.assertEqual(ids[0], first.id)
+            self.assertEqual(ids[1], ids[2])
+            self.assertEqual(self.Activity.search([], count=True), 3)
+
+            # The duplicates straddling two windows are found too
+            now = time.time
+            self.addCleanup(setattr, time, 'time', now)
+            time.time = lambda: 3600 * 100000 - 1
+            liked, = self.Activity.create([dict(values, verb='Liked again')])
+            time.time = lambda: 3600 * 100000
+            activity, = self.Activity.create([
+                dict(values, verb='Liked again')
+            ])
+            self.assertEqual(activity, liked)
+            ids = self.Activity.bulk_record([dict(values, verb='Liked again')])
+            self.assertEqual(ids, [liked.id])
+            # but not past the previous window
+            time.time = lambda: 3600 * 100001
+            activity, = self.Activity.create([
+                dict(values, verb='Liked again')
+            ])
+            self.assertNotEqual(activity, liked)
+            time.time = now
+
+            # The required fields are still checked
+            self.assertRaises(
+                UserError, self.Activity.create, [dict(values, verb=None)]
+            )
+
+            # The copies do not keep the key of the original
+            config.set('activity_stream', 'dedup_interval', '0')
+            copy, = self.Activity.copy([first])
+            self.assertNotEqual(copy, first)
+            self.assertEqual(copy.dedup_key, None)
+
+    def test0035_models_get(self):
+        '''
+        Cache the allowed models until they change
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            models_cache = self.Activity._models_cache
+            self.assertEqual(self.Activity.models_get(), [(None, '')])
+
+            hits = models_cache.hits
+            self.Activity.models_get()
+            self.assertEqual(models_cache.hits, hits + 1)
+
+            party_model, = self.Model.search([
+                ('model', '=', 'party.party')
+            ], limit=1)
+            allowed_model, = self.ActivityAllowedModel.create([{
+                'name': 'Party',
+                'model': party_model,
+            }])
+            misses = models_cache.misses
+            self.assertEqual(
+                self.Activity.models_get(),
+                [(None, ''), ('party.party', 'Party')]
+            )
+            self.assertEqual(models_cache.misses, misses + 1)
+            self.assertEqual(
+                self.Activity.get_allowed_models(),
+                frozenset(['party.party'])
+            )
+
+            self.ActivityAllowedModel.delete([allowed_model])
+            self.assertEqual(self.Activity.models_get(), [(None, '')])
+
     def test0020_stream(self):
         '''
         Serialize Activity Stream
@@ -294,44 +700,1163 @@ class ActivityTestCase(NereidTestCase):
                 rv_json = json.loads(rv.data)
                 self.assertEqual(rv_json['totalItems'], 3)
 
-    def test0030_public_stream(self):
+    def test0032_stream_cursor(self):
         '''
-        Checks public stream
+        Page through the activity stream with the before cursor
         '''
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
             app = self.get_app()
 
-            user_model, = self.Model.search([
+            nereid_user_model, = self.Model.search([
                 ('model', '=', 'nereid.user')
             ])
-
             self.ActivityAllowedModel.create([{
                 'name': 'User',
-                'model': user_model.id,
+                'model': nereid_user_model,
             }])
-
-            # Create Activities
             self.Activity.create([{
                 'verb': 'Added a new friend',
                 'actor': self.registered_user,
-                'object_': 'nereid.user,%s' % self.user_party.id,
-            }])
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            } for i in range(3)])
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/user/activity-stream?limit=2')
+                first_page = json.loads(rv.data)
+                self.assertEqual(len(first_page['items']), 2)
+                self.assertEqual(first_page['totalItems'], 3)
+                self.assertFalse(first_page['totalItemsEstimated'])
+                self.assertTrue(first_page['next'])
+
+                rv = c.get(
+                    '/user/activity-stream?limit=2&before=%s'
+                    % first_page['next']
+                )
+                second_page = json.loads(rv.data)
+                self.assertEqual(len(second_page['items']), 1)
+                self.assertEqual(second_page['totalItems'], 3)
+                self.assertEqual(second_page['next'], None)
+
+                # Offset paging still works
+                rv = c.get('/user/activity-stream?limit=2&offset=2')
+                self.assertEqual(
+                    json.loads(rv.data)['items'], second_page['items']
+                )
+
+                rv = c.get('/user/activity-stream?before=invalid')
+                self.assertEqual(rv.status_code, 400)
+
+    def test0037_streaming_response(self):
+        '''
+        Stream the activity stream in batches
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
 
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
             self.Activity.create([{
-                'verb': 'Added a friend to a list',
+                'verb': 'Added a new friend',
                 'actor': self.registered_user,
-                'object_': 'nereid.user,%s' % self.user_party.id,
-                'target': 'nereid.user,%s' % self.user_party.id,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            } for i in range(5)])
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                for args in ('limit=4', 'limit=10', 'limit=2&offset=1'):
+                    rv = c.get('/user/activity-stream?' + args)
+                    page = json.loads(rv.data)
+                    rv = c.get('/user/activity-stream?stream=1&' + args)
+                    self.assertEqual(json.loads(rv.data), page)
+
+    def test0038_conditional_get(self):
+        '''
+        Answer polls of an unchanged stream with 304 Not Modified
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
             }])
+            values = {
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            }
+            self.Activity.create([values])
 
             with app.test_client() as c:
-                # Get public activity stream
-                rv = c.get('/activity-stream')
-                rv_json = json.loads(rv.data)
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
 
-                # No activity stream available publicly
-                self.assertEqual(rv_json['totalItems'], 0)
+                rv = c.get('/user/activity-stream')
+                self.assertEqual(rv.status_code, 200)
+                etag = rv.headers['ETag']
+                self.assertTrue(rv.headers['Last-Modified'])
+
+                rv = c.get('/user/activity-stream', headers={
+                    'If-None-Match': etag,
+                })
+                self.assertEqual(rv.status_code, 304)
+
+                # Other page arguments have another validator
+                rv = c.get('/user/activity-stream?limit=1', headers={
+                    'If-None-Match': etag,
+                })
+                self.assertEqual(rv.status_code, 200)
+
+                self.Activity.create([values])
+                rv = c.get('/user/activity-stream', headers={
+                    'If-None-Match': etag,
+                })
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(json.loads(rv.data)['totalItems'], 2)
+
+    def test0039_since(self):
+        '''
+        Poll the activities newer than a page
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            values = {
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            }
+            self.Activity.create([values])
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/user/activity-stream')
+                latest = json.loads(rv.data)['latest']
+
+                rv = c.get('/user/activity-stream?since=%s' % latest)
+                rv_json = json.loads(rv.data)
+                self.assertEqual(rv_json['totalItems'], 0)
+                self.assertEqual(rv_json['latest'], None)
+                self.assertFalse(rv_json['resync'])
+
+                self.Activity.create([values, values])
+                rv = c.get('/user/activity-stream?since=%s' % latest)
+                rv_json = json.loads(rv.data)
+                self.assertEqual(rv_json['totalItems'], 2)
+                self.assertFalse(rv_json['resync'])
+
+                rv = c.get(
+                    '/user/activity-stream?limit=1&since=%s' % latest
+                )
+                rv_json = json.loads(rv.data)
+                self.assertEqual(len(rv_json['items']), 1)
+                self.assertEqual(rv_json['totalItems'], 2)
+                self.assertTrue(rv_json['resync'])
+
+    def test0040_push(self):
+        '''
+        Push the new activities to the subscribers
+        '''
+        broker = MemoryBackend()
+        self.addCleanup(activity_broker.set_backend, activity_broker.backend)
+        activity_broker.set_backend(broker)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+
+            subscription = broker.subscribe([
+                ('actor', self.registered_user.id)
+            ])
+            activity, = self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            }])
+            # Published once the transaction is committed
+            self.assertEqual(subscription.wait(0), [])
+            self.commit_hooks()
+            self.assertEqual(subscription.wait(0), [[activity.id]])
+            subscription.close()
+            self.assertEqual(broker.subscriptions, {})
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/user/activity-stream')
+                latest = json.loads(rv.data)['latest']
+
+                self.Activity.create([{
+                    'verb': 'Added a friend to a list',
+                    'actor': self.registered_user,
+                    'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+                }])
+                rv = c.get(
+                    '/user/activity-stream/push?timeout=0',
+                    headers={'Last-Event-ID': latest}
+                )
+                self.assertEqual(rv.mimetype, 'text/event-stream')
+                events = [
+                    line for line in rv.data.splitlines()
+                    if line.startswith('data: ')
+                ]
+                self.assertEqual(len(events), 1)
+                event = json.loads(events[0][len('data: '):])
+                self.assertEqual(event['totalItems'], 1)
+                self.assertEqual(
+                    event['items'][0]['verb'], 'Added a friend to a list'
+                )
+
+    def test0031_serialize_many(self):
+        '''
+        Serialize activities in bulk
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': user_model.id,
+            }])
+
+            new_party, = self.Party.create([{'name': 'Tarun'}])
+            new_nereid_user, = self.NereidUser.create([{
+                'party': new_party.id,
+                'company': self.company.id,
+                'display_name': new_party.name
+            }])
+            activities = self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            }, {
+                'verb': 'Added a friend to a list',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+                'target': 'nereid.user,%s' % new_nereid_user.id,
+            }, {
+                'verb': 'Added a new friend',
+                'actor': self.nereid_user_actor,
+                'object_': 'nereid.user,%s' % new_nereid_user.id,
+            }])
+
+            items = self.Activity.serialize_many(activities)
+            self.assertEqual(len(items), 3)
+            self.assertEqual(
+                items, [activity.serialize() for activity in activities]
+            )
+            self.assertEqual(
+                items[1]['target']['id'], new_nereid_user.id
+            )
+
+            # Activities referring to the deleted user are dropped
+            self.NereidUser.delete([new_nereid_user])
+            items = self.Activity.serialize_many(activities)
+            self.assertEqual(len(items), 1)
+            self.assertEqual(items[0]['verb'], 'Added a new friend')
+
+    def test0045_total(self):
+        '''
+        Count the stream up to the threshold and estimate beyond
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            activities = self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            } for i in range(3)])
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/user/activity-stream?limit=1')
+                rv_json = json.loads(rv.data)
+                self.assertEqual(rv_json['totalItems'], 3)
+                self.assertFalse(rv_json['totalItemsEstimated'])
+
+                # The total is cached until an activity is deleted
+                hits = self.Activity._count_cache.hits
+                rv = c.get('/user/activity-stream?limit=2')
+                self.assertEqual(json.loads(rv.data)['totalItems'], 3)
+                self.assertEqual(
+                    self.Activity._count_cache.hits, hits + 1
+                )
+                self.Activity.delete([activities[0]])
+                rv = c.get('/user/activity-stream?limit=2')
+                self.assertEqual(json.loads(rv.data)['totalItems'], 2)
+
+                rv = c.get('/user/activity-stream?limit=1&stream=1')
+                self.assertEqual(json.loads(rv.data)['totalItems'], 2)
+
+                # and until an activity is changed
+                url = '/user/activity-stream?limit=1&verb=Added+a+new+friend'
+                rv = c.get(url)
+                self.assertEqual(json.loads(rv.data)['totalItems'], 2)
+                self.Activity.write([activities[1]], {'verb': 'Liked'})
+                rv = c.get(url)
+                self.assertEqual(json.loads(rv.data)['totalItems'], 1)
+
+                if not config.has_section('activity_stream'):
+                    config.add_section('activity_stream')
+                config.set('activity_stream', 'count_threshold', '1')
+                self.addCleanup(
+                    config.remove_option, 'activity_stream', 'count_threshold'
+                )
+                self.Activity._count_cache.clear()
+                rv = c.get('/user/activity-stream?limit=1')
+                rv_json = json.loads(rv.data)
+                self.assertTrue(rv_json['totalItemsEstimated'])
+                self.assertTrue(rv_json['totalItems'] >= 2)
+
+    def test0044_filters(self):
+        '''
+        Filter the stream by verb, object model, target and time
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            user_model, party_model = self.Model.search([
+                ('model', 'in', ['nereid.user', 'party.party'])
+            ], order=[('model', 'DESC')])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': user_model.id,
+            }, {
+                'name': 'Party',
+                'model': party_model.id,
+            }])
+            target = 'party.party,%s' % self.user_party.id
+            activity, = self.Activity.create([{
+                'verb': 'Liked',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+                'target': target,
+            }])
+            self.Activity.create([{
+                'verb': 'Commented',
+                'actor': self.registered_user,
+                'object_': 'party.party,%s' % self.user_party.id,
+            }, {
+                'verb': 'Shared',
+                'actor': self.registered_user,
+                'object_': 'party.party,%s' % self.user_party.id,
+            }])
+            self.assertEqual(activity.object_model, 'nereid.user')
+            self.assertEqual(activity.target_model, 'party.party')
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                def verbs(query_string):
+                    rv = c.get('/user/activity-stream?' + query_string)
+                    return sorted(
+                        i['verb'] for i in json.loads(rv.data)['items']
+                    )
+
+                self.assertEqual(
+                    verbs('verb=Liked&verb=Shared'), ['Liked', 'Shared']
+                )
+                self.assertEqual(
+                    verbs('object=party.party'), ['Commented', 'Shared']
+                )
+                self.assertEqual(verbs('target=%s' % target), ['Liked'])
+                published = activity.create_date
+                self.assertEqual(
+                    len(verbs('from=%s' % published.isoformat())), 3
+                )
+                self.assertEqual(
+                    verbs('to=%s' % published.isoformat()), []
+                )
+
+                rv = c.get('/user/activity-stream?object=ir.model')
+                self.assertEqual(rv.status_code, 400)
+                rv = c.get('/user/activity-stream?from=yesterday')
+                self.assertEqual(rv.status_code, 400)
+
+                # The hot days only restrict the head of the stream
+                table = self.Activity.__table__()
+                published -= timedelta(days=10)
+                Transaction().cursor.execute(*table.update(
+                    [table.create_date, table.score],
+                    [published, self.Activity.score_from_date(published)],
+                    where=table.id == activity.id
+                ))
+                if not config.has_section('activity_stream'):
+                    config.add_section('activity_stream')
+                config.set('activity_stream', 'hot_days', '7')
+                self.addCleanup(
+                    config.remove_option, 'activity_stream', 'hot_days'
+                )
+                rv = c.get('/user/activity-stream?limit=2')
+                rv_json = json.loads(rv.data)
+                self.assertTrue(rv_json['truncated'])
+                self.assertEqual(
+                    sorted(i['verb'] for i in rv_json['items']),
+                    ['Commented', 'Shared']
+                )
+                rv = c.get(
+                    '/user/activity-stream?limit=2&before=%s'
+                    % rv_json['next']
+                )
+                rv_json = json.loads(rv.data)
+                self.assertNotIn('truncated', rv_json)
+                self.assertEqual(
+                    [i['verb'] for i in rv_json['items']], ['Liked']
+                )
+                self.assertEqual(
+                    verbs('from=%s' % published.isoformat()),
+                    ['Commented', 'Liked', 'Shared']
+                )
+
+    def test0041_aggregate(self):
+        '''
+        Collapse the similar activities of a window of time
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': user_model.id,
+            }])
+            object_ = 'nereid.user,%s' % self.nereid_stream_owner.id
+            self.Activity.create([{
+                'verb': 'Liked',
+                'actor': self.nereid_user_actor,
+                'object_': object_,
+            }, {
+                'verb': 'Liked',
+                'actor': self.registered_user,
+                'object_': object_,
+            }, {
+                'verb': 'Liked',
+                'actor': self.registered_user,
+                'object_': object_,
+            }, {
+                'verb': 'Commented',
+                'actor': self.registered_user,
+                'object_': object_,
+            }])
+
+            aggregates = self.Activity.aggregate([], 3600)
+            self.assertEqual(len(aggregates), 2)
+            items = self.Activity.serialize_aggregates(aggregates)
+            self.assertEqual(
+                [(i['verb'], i['count']) for i in items],
+                [('Commented', 1), ('Liked', 3)]
+            )
+            self.assertEqual(
+                [actor['id'] for actor in items[1]['actors']],
+                [self.registered_user.id, self.nereid_user_actor.id]
+            )
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/user/activity-stream?aggregate=3600')
+                rv_json = json.loads(rv.data)
+                self.assertEqual(len(rv_json['items']), 2)
+                self.assertEqual(rv_json['items'][1]['count'], 2)
+                # The total is the one of the activities of the stream
+                self.assertEqual(rv_json['totalItems'], 3)
+                self.assertEqual(rv_json['next'], None)
+
+                rv = c.get('/user/activity-stream?aggregate=3600&limit=1')
+                rv_json = json.loads(rv.data)
+                self.assertEqual(rv_json['items'][0]['verb'], 'Commented')
+                rv = c.get(
+                    '/user/activity-stream?aggregate=3600&limit=1&before=%s'
+                    % rv_json['next']
+                )
+                rv_json = json.loads(rv.data)
+                self.assertEqual(
+                    [(i['verb'], i['count']) for i in rv_json['items']],
+                    [('Liked', 2)]
+                )
+
+            # The groups of older windows are found past the empty ones
+            old_activity, = self.Activity.create([{
+                'verb': 'Liked',
+                'actor': self.nereid_user_actor,
+                'object_': object_,
+                'target': object_,
+            }])
+            table = self.Activity.__table__()
+            create_date = old_activity.create_date - timedelta(days=10)
+            Transaction().cursor.execute(*table.update(
+                [table.create_date, table.score],
+                [create_date, self.Activity.score_from_date(create_date)],
+                where=table.id == old_activity.id
+            ))
+            aggregates = self.Activity.aggregate([], 3600, limit=2)
+            self.assertEqual(len(aggregates), 2)
+            aggregates = self.Activity.aggregate(
+                [], 3600, limit=2, before=aggregates[-1][3]
+            )
+            self.assertEqual(
+                [(a[0], a[1], a[2]) for a in aggregates],
+                [(old_activity.id, 1, [self.nereid_user_actor.id])]
+            )
+
+    def test0034_serialized_cache(self):
+        '''
+        Serve the serialized activities from the cache until they change
+        '''
+        backend = DictBackend()
+        self.addCleanup(serialized_cache.set_backend, serialized_cache.backend)
+        serialized_cache.set_backend(backend)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': user_model.id,
+            }])
+            activity, = self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            }])
+
+            item = activity.serialize()
+            self.assertEqual(len(backend.data), 1)
+
+            # Changes to the returned dictionary do not leak in the cache
+            item['verb'] = 'Changed'
+            self.assertEqual(
+                activity.serialize()['verb'], 'Added a new friend'
+            )
+
+            # Changing the object builds the entry again
+            self.NereidUser.write([self.nereid_user_actor], {
+                'display_name': 'New Name',
+            })
+            self.assertEqual(
+                activity.serialize()['object']['displayName'], 'New Name'
+            )
+
+            self.Activity.delete([activity])
+            self.assertEqual(backend.data, {})
+
+    def test0033_fanout_stream(self):
+        '''
+        Read the activity stream from the fanned out timeline
+        '''
+        Timeline = POOL.get('nereid.activity.timeline')
+
+        if not config.has_section('activity_stream'):
+            config.add_section('activity_stream')
+        config.set('activity_stream', 'fanout', 'True')
+        self.addCleanup(config.remove_option, 'activity_stream', 'fanout')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            activities = self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            }, {
+                'verb': 'Added a new friend',
+                'actor': self.nereid_user_actor,
+                'object_': 'nereid.user,%s' % self.registered_user.id,
+            }])
+
+            entries = Timeline.search([])
+            self.assertEqual(len(entries), 2)
+            self.assertEqual(
+                set((e.user, e.activity) for e in entries),
+                set([
+                    (self.registered_user, activities[0]),
+                    (self.nereid_user_actor, activities[1]),
+                ])
+            )
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/user/activity-stream')
+                rv_json = json.loads(rv.data)
+                self.assertEqual(rv_json['totalItems'], 1)
+                self.assertEqual(
+                    rv_json['items'][0]['actor']['id'],
+                    self.registered_user.id
+                )
+
+                # The pages are read from the timeline
+                newest, = self.Activity.create([{
+                    'verb': 'Liked',
+                    'actor': self.registered_user,
+                    'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+                }])
+                rv = c.get('/user/activity-stream?limit=1')
+                rv_json = json.loads(rv.data)
+                self.assertEqual(rv_json['totalItems'], 2)
+                self.assertEqual(
+                    rv_json['next'], self.Activity.encode_cursor(newest)
+                )
+                rv = c.get(
+                    '/user/activity-stream?limit=1&before=%s'
+                    % rv_json['next']
+                )
+                self.assertEqual(
+                    [i['verb'] for i in json.loads(rv.data)['items']],
+                    ['Added a new friend']
+                )
+                self.assertEqual(
+                    self.Activity.timeline_search(
+                        [('verb', '=', 'Added a new friend')],
+                        self.registered_user.id, 0, 10
+                    ),
+                    [activities[0]]
+                )
+
+    def test0046_merge_search(self):
+        '''
+        Merge the activities of several actors into the stream order
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            actors = [self.registered_user, self.nereid_user_actor]
+            self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': actors[i % 3 == 0],
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            } for i in range(7)])
+
+            actor_ids = map(int, actors)
+            domain = [('actor', 'in', actor_ids)]
+            for offset, limit in [(0, 3), (2, 4), (5, 10)]:
+                self.assertEqual(
+                    self.Activity.merge_search(
+                        domain, actor_ids, offset, limit
+                    ),
+                    self.Activity.search(domain, offset=offset, limit=limit)
+                )
+            self.assertEqual(
+                self.Activity.merge_search(
+                    [('verb', '=', 'Liked')], actor_ids, 0, 10
+                ),
+                []
+            )
+
+    def test0047_sparse_fields(self):
+        '''
+        Serialize only the fields asked for
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            activity, = self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+                'target': 'nereid.user,%s' % self.registered_user.id,
+            }])
+
+            item, = self.Activity.serialize_many(
+                [activity], ['verb', 'actor', 'object.id']
+            )
+            self.assertEqual(item, {
+                'verb': 'Added a new friend',
+                'actor': self.registered_user.serialize('activity_stream'),
+                'object': {
+                    'objectType': 'nereid.user',
+                    'id': self.nereid_user_actor.id,
+                },
+            })
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/user/activity-stream?fields=ids')
+                item, = json.loads(rv.data)['items']
+                self.assertEqual(item, {
+                    'id': activity.id,
+                    'published': activity.create_date.isoformat(),
+                    'verb': 'Added a new friend',
+                    'actor': {
+                        'objectType': 'nereid.user',
+                        'id': self.registered_user.id,
+                    },
+                    'object': {
+                        'objectType': 'nereid.user',
+                        'id': self.nereid_user_actor.id,
+                    },
+                    'target': {
+                        'objectType': 'nereid.user',
+                        'id': self.registered_user.id,
+                    },
+                })
+
+                rv = c.get('/user/activity-stream?fields=id,verb&stream=1')
+                item, = json.loads(rv.data)['items']
+                self.assertEqual(item, {
+                    'id': activity.id,
+                    'verb': 'Added a new friend',
+                })
+
+                rv = c.get('/user/activity-stream?fields=id,email')
+                self.assertEqual(rv.status_code, 400)
+
+    def test0048_response_formats(self):
+        '''
+        Negotiate the compression and format of the stream
+        '''
+        if not config.has_section('activity_stream'):
+            config.add_section('activity_stream')
+        config.set('activity_stream', 'compress_min_size', '0')
+        self.addCleanup(
+            config.remove_option, 'activity_stream', 'compress_min_size'
+        )
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            } for i in range(2)])
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/user/activity-stream')
+                self.assertFalse('Content-Encoding' in rv.headers)
+                rv_json = json.loads(rv.data)
+
+                rv = c.get('/user/activity-stream', headers={
+                    'Accept-Encoding': 'gzip, deflate',
+                })
+                self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(json.loads(
+                    zlib.decompress(rv.data, 16 + zlib.MAX_WBITS)
+                ), rv_json)
+
+                rv = c.get('/user/activity-stream', headers={
+                    'Accept-Encoding': 'deflate',
+                })
+                self.assertEqual(rv.headers['Content-Encoding'], 'deflate')
+                self.assertEqual(json.loads(zlib.decompress(rv.data)), rv_json)
+
+                rv = c.get('/user/activity-stream?entities=1')
+                entities_json = json.loads(rv.data)
+                key = 'nereid.user,%s' % self.registered_user.id
+                self.assertEqual(
+                    [item['actor'] for item in entities_json['items']],
+                    [key, key]
+                )
+                self.assertEqual(
+                    entities_json['entities'][key],
+                    rv_json['items'][0]['actor']
+                )
+
+                if msgpack is not None:
+                    rv = c.get('/user/activity-stream', headers={
+                        'Accept': 'application/x-msgpack',
+                    })
+                    self.assertEqual(
+                        rv.mimetype, 'application/x-msgpack'
+                    )
+                    self.assertEqual(
+                        msgpack.unpackb(rv.data)['totalItems'], 2
+                    )
+
+    def test0050_metrics(self):
+        '''
+        Instrument the activity stream
+        '''
+        sink = MemorySink()
+        self.addCleanup(activity_metrics.set_sink, activity_metrics.sink)
+        activity_metrics.set_sink(sink)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            }])
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/user/activity-stream')
+                self.assertEqual(rv.status_code, 200)
+                self.assertFalse('X-Activity-Timing' in rv.headers)
+                for name in [
+                        'stream', 'search', 'count', 'exists', 'serialize',
+                        'serialize.nereid.user', 'render']:
+                    self.assertTrue(sink.timings.get(name), name)
+                self.assertTrue(sink.counters['queries'] > 0)
+                self.assertEqual(sink.counters['bytes'], len(rv.data))
+
+                if not config.has_section('activity_stream'):
+                    config.add_section('activity_stream')
+                config.set('activity_stream', 'timing_header', 'True')
+                self.addCleanup(
+                    config.remove_option, 'activity_stream', 'timing_header'
+                )
+                activity_metrics.set_sink(None)
+                rv = c.get('/user/activity-stream')
+                self.assertTrue(
+                    'stream;dur=' in rv.headers['X-Activity-Timing']
+                )
+                self.assertTrue(
+                    'queries;count=' in rv.headers['X-Activity-Timing']
+                )
+
+            activity_metrics.set_sink(sink)
+            self.Activity.serialize_many(self.Activity.browse([-1]))
+            self.assertEqual(sink.counters['dangling'], 1)
+
+    def test0051_public_window(self):
+        '''
+        Serve the first pages of the public stream from memory
+        '''
+        sink = MemorySink()
+        self.addCleanup(activity_metrics.set_sink, activity_metrics.sink)
+        activity_metrics.set_sink(sink)
+        self.addCleanup(
+            public_window.configure, public_window.size, public_window.ttl
+        )
+        public_window.configure(3, 60)
+        self.Activity.get_public_stream_domain = classmethod(lambda cls: [])
+        self.addCleanup(
+            delattr, self.Activity, 'get_public_stream_domain'
+        )
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            nereid_user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': nereid_user_model,
+            }])
+            values = {
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.nereid_user_actor.id,
+            }
+            self.Activity.create([values, values])
+
+            with app.test_client() as c:
+                rv = c.get('/activity-stream')
+                rv_json = json.loads(rv.data)
+                self.assertEqual(len(rv_json['items']), 2)
+                self.assertEqual(sink.counters['public_window.hits'], 1)
+
+                # Served without any query
+                with activity_metrics.collect() as collected:
+                    with activity_metrics.count_queries():
+                        rv = c.get('/activity-stream')
+                self.assertEqual(json.loads(rv.data), rv_json)
+                self.assertFalse(collected['counters'].get('queries'))
+                rv = c.get('/activity-stream', headers={
+                    'If-None-Match': rv.headers['ETag'],
+                })
+                self.assertEqual(rv.status_code, 304)
+
+                # The new activities are added to the window
+                activity, = self.Activity.create([values])
+                self.commit_hooks()
+                rv = c.get('/activity-stream?limit=1')
+                rv_json = json.loads(rv.data)
+                self.assertEqual(rv_json['totalItems'], 3)
+                self.assertEqual(
+                    rv_json['latest'], self.Activity.encode_cursor(activity)
+                )
+                self.assertEqual(
+                    rv_json['next'], self.Activity.encode_cursor(activity)
+                )
+                rv = c.get('/activity-stream?offset=1&limit=5')
+                self.assertEqual(len(json.loads(rv.data)['items']), 2)
+                self.assertEqual(sink.counters['public_window.hits'], 5)
+
+                # Past the window, the page is read from the database
+                self.Activity.create([values])
+                self.commit_hooks()
+                rv = c.get('/activity-stream?offset=2&limit=2')
+                rv_json = json.loads(rv.data)
+                self.assertEqual(len(rv_json['items']), 2)
+                self.assertEqual(rv_json['totalItems'], 4)
+                self.assertEqual(sink.counters['public_window.misses'], 1)
+
+                rv = c.get('/activity-stream?verb=Liked')
+                self.assertEqual(json.loads(rv.data)['totalItems'], 0)
+                self.assertEqual(sink.counters['public_window.hits'], 5)
+
+    def test0030_public_stream(self):
+        '''
+        Checks public stream
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            user_model, = self.Model.search([
+                ('model', '=', 'nereid.user')
+            ])
+
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': user_model.id,
+            }])
+
+            # Create Activities
+            self.Activity.create([{
+                'verb': 'Added a new friend',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.user_party.id,
+            }])
+
+            self.Activity.create([{
+                'verb': 'Added a friend to a list',
+                'actor': self.registered_user,
+                'object_': 'nereid.user,%s' % self.user_party.id,
+                'target': 'nereid.user,%s' % self.user_party.id,
+            }])
+
+            with app.test_client() as c:
+                # Get public activity stream
+                rv = c.get('/activity-stream')
+                rv_json = json.loads(rv.data)
+
+                # No activity stream available publicly
+                self.assertEqual(rv_json['totalItems'], 0)
+
+    def test0053_reference_stream(self):
+        '''
+        Get the streams of the activities on an object and on a target
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            user_model, party_model = self.Model.search([
+                ('model', 'in', ['nereid.user', 'party.party'])
+            ], order=[('model', 'DESC')])
+            self.ActivityAllowedModel.create([{
+                'name': 'User',
+                'model': user_model.id,
+            }, {
+                'name': 'Party',
+                'model': party_model.id,
+            }])
+            actor = 'nereid.user,%s' % self.nereid_user_actor.id
+            party = 'party.party,%s' % self.user_party.id
+            self.Activity.create([{
+                'verb': 'Liked',
+                'actor': self.registered_user,
+                'object_': actor,
+                'target': party,
+            } for i in range(3)])
+            activity, = self.Activity.create([{
+                'verb': 'Commented',
+                'actor': self.registered_user,
+                'object_': party,
+            }])
+            self.Activity.bulk_record([{
+                'verb': 'Shared',
+                'actor': self.registered_user,
+                'object_': party,
+                'target': actor,
+            }])
+            # Activity of another user, which the user does not follow
+            self.Activity.create([{
+                'verb': 'Commented',
+                'actor': self.nereid_user_actor,
+                'object_': party,
+                'target': party,
+            }])
+            self.assertEqual(activity.object_model, 'party.party')
+            self.assertEqual(activity.object_id, self.user_party.id)
+            self.assertEqual(activity.target_id, None)
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                url = '/activity-stream/object/nereid.user/%s' \
+                    % self.nereid_user_actor.id
+                rv = c.get(url + '?limit=2')
+                first_page = json.loads(rv.data)
+                self.assertEqual(len(first_page['items']), 2)
+                self.assertEqual(first_page['totalItems'], 3)
+                self.assertTrue(first_page['next'])
+                rv = c.get(url + '?limit=2&before=%s' % first_page['next'])
+                self.assertEqual(len(json.loads(rv.data)['items']), 1)
+
+                rv = c.get(
+                    '/activity-stream/object/party.party/%s'
+                    % self.user_party.id
+                )
+                self.assertEqual(
+                    sorted(i['verb'] for i in json.loads(rv.data)['items']),
+                    ['Commented', 'Shared']
+                )
+                rv = c.get(
+                    '/activity-stream/target/party.party/%s'
+                    % self.user_party.id
+                )
+                self.assertEqual(json.loads(rv.data)['totalItems'], 3)
+                rv = c.get(url.replace('object', 'target'))
+                self.assertEqual(
+                    [i['verb'] for i in json.loads(rv.data)['items']],
+                    ['Shared']
+                )
+
+                rv = c.get('/activity-stream/object/ir.model/1')
+                self.assertEqual(rv.status_code, 404)
 
 
 def suite():